@@ -50,7 +50,8 @@ class HostCardEmulatorService: HostApduService() {
         if (hexCommandApdu.substring(10, 24) == AID) {
             val dataStore = DataStoreUtil(this);
             val uid = dataStore.getID();
-            return ByteArrayHexUtil.hexStringToByteArray(uid)
+            // the lock only takes the UID from a response ending in 9000
+            return ByteArrayHexUtil.hexStringToByteArray(uid + STATUS_SUCCESS)
         } else {
             return ByteArrayHexUtil.hexStringToByteArray(STATUS_FAILED)
         }
@@ -0,0 +1,218 @@
+# Access log on flash.
+#
+# Every access decision is kept as a fixed size record (RECORD_SIZE bytes)
+# in a ring of `segments` files (access.0, access.1, ...), `segment_records`
+# records each. Record n lives in segment (n // segment_records) % segments
+# at slot n % segment_records, and a segment file is truncated when the
+# writer moves into it, which drops the oldest records. Records carry their
+# number, so the end of the log is found again after a reboot.
+#
+# add() only packs the record into a RAM buffer. loop() writes the buffer out
+# every flush_interval seconds, or as soon as it is half full, so flash sees
+# a few larger writes and handle_auth never waits for it. Records that do
+# not fit in a full buffer are counted as dropped.
+#
+# For uploading, read() returns flushed records from the upload cursor on
+# and ack() moves the cursor. The cursor is kept in <prefix>.cur, so an
+# upload that was cut short continues where it stopped.
+#
+# The RTC starts at 2000-01-01 after a power loss, so time is 0 until Net set
+# the clock (time_synced). Every record also carries the boot it was written
+# in, counted in <prefix>.boot, and the ms since that boot: the server dates
+# a record without time from a later one of the same boot that has it.
+#
+# Record (little endian):
+#   u32 number, u32 time (utime.time(), 0 before the clock was set), 8s key,
+#   u8 decision, u8 card type (0 card, 1 phone), u8 door, u8 boot (wraps),
+#   u16 PIN entry ms, u16 hash us, u16 lookup us, u16 total ms,
+#   u32 uptime ms (utime.ticks_ms(), wraps after 2**30 on the ESP32)
+# key is the start of the digest for GRANTED and DENIED, and the card UID
+# (zero padded) for TIMEOUT, THROTTLED and REMOVED.
+
+import asyncio
+import os
+import struct
+import utime
+from credentials import CARD_ANDROID
+
+RECORD = '<II8sBBBBHHHHI'
+RECORD_SIZE = struct.calcsize(RECORD)
+
+DENIED = 0
+GRANTED = 1
+TIMEOUT = 2
+THROTTLED = 3
+# card taken away before the PIN was complete (PIN_NEEDS_CARD)
+REMOVED = 4
+
+
+def _u16(v):
+    return v if v < 0xFFFF else 0xFFFF
+
+
+def decode(records):
+    """Decode uploaded records into a list of tuples in RECORD order."""
+    return [struct.unpack_from(RECORD, records, i) for i in range(0, len(records) - RECORD_SIZE + 1, RECORD_SIZE)]
+
+
+class AccessLog:
+    def __init__(self, prefix='access', segments=4, segment_records=512, buffer_records=16, flush_interval=10):
+        self._prefix = prefix
+        self.segments = segments
+        self.segment_records = segment_records
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.lost = 0
+        self.time_synced = False
+
+        self._buf = bytearray(buffer_records * RECORD_SIZE)
+        self._pending = 0
+        self._chunk = None
+        self._flush_due = asyncio.Event()
+
+        # number of the next record written to flash
+        self.head = self._recover()
+        self.cursor = min(self._load('.cur'), self.head)
+        self.boot = (self._load('.boot') + 1) & 0xFF
+        try:
+            self._save('.boot', self.boot)
+        except OSError as e:
+            print(f"access log boot count not saved: {e}")
+
+    def _path(self, segment):
+        return f"{self._prefix}.{segment % self.segments}"
+
+    def _recover(self):
+        head = 0
+        rec = bytearray(RECORD_SIZE)
+        for i in range(self.segments):
+            path = self._path(i)
+            try:
+                size = os.stat(path)[6]
+                with open(path, 'rb') as f:
+                    if f.readinto(rec) != RECORD_SIZE:
+                        continue
+            except OSError:
+                continue
+            first = struct.unpack_from('<I', rec)[0]
+            if first % self.segment_records or (first // self.segment_records) % self.segments != i:
+                # not a segment start, leave it to be overwritten
+                continue
+            head = max(head, first + min(size // RECORD_SIZE, self.segment_records))
+        return head
+
+    def _load(self, suffix):
+        try:
+            with open(self._prefix + suffix) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _save(self, suffix, value):
+        tmp = self._prefix + suffix + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(value))
+        os.rename(tmp, self._prefix + suffix)
+
+    def oldest(self):
+        """Number of the oldest record still on flash."""
+        n = self.segment_records
+        return max(0, ((self.head + n - 1) // n - self.segments) * n)
+
+    def stats(self):
+        return {
+            'head': self.head,
+            'uploaded': self.cursor,
+            'pending': self._pending,
+            'dropped': self.dropped,
+            'lost': self.lost,
+            'boot': self.boot,
+            'time_synced': self.time_synced,
+        }
+
+    def add(self, decision, key, card_type, door=0, pin_ms=0, hash_us=0, lookup_us=0, total_ms=0):
+        i = self._pending * RECORD_SIZE
+        if i == len(self._buf):
+            self.dropped += 1
+            return
+        now = utime.time() if self.time_synced else 0
+        struct.pack_into(RECORD, self._buf, i, self.head + self._pending, now, bytes(key[:8]),
+                         decision, 1 if card_type == CARD_ANDROID else 0, door, self.boot,
+                         _u16(pin_ms), _u16(hash_us), _u16(lookup_us), _u16(total_ms),
+                         utime.ticks_ms() & 0xFFFFFFFF)
+        self._pending += 1
+        if 2 * (i + RECORD_SIZE) >= len(self._buf):
+            self._flush_due.set()
+
+    def flush(self):
+        """Write the buffered records to flash."""
+        n = self._pending
+        seq = self.head
+        done = 0
+        buf = memoryview(self._buf)
+        try:
+            while done < n:
+                segment, slot = divmod(seq, self.segment_records)
+                count = min(n - done, self.segment_records - slot)
+                # a new segment replaces the oldest one
+                with open(self._path(segment), 'r+b' if slot else 'wb') as f:
+                    f.seek(slot * RECORD_SIZE)
+                    f.write(buf[done * RECORD_SIZE:(done + count) * RECORD_SIZE])
+                done += count
+                seq += count
+        finally:
+            self.dropped += n - done
+            self.head = seq
+            self._pending = 0
+
+    async def loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_due.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_due.clear()
+            if self._pending:
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"access log write failed: {e}")
+
+    def read(self, max_records=32):
+        """
+        Return (number, records): flushed records from the upload cursor on,
+        at most max_records and never across a segment. records is empty when
+        everything was uploaded. The buffer is reused by the next call.
+        """
+        oldest = self.oldest()
+        if self.cursor < oldest:
+            # overwritten before they were uploaded
+            self.lost += oldest - self.cursor
+            self.cursor = oldest
+        seq = self.cursor
+        segment, slot = divmod(seq, self.segment_records)
+        n = min(max_records, self.head - seq, self.segment_records - slot)
+        if n <= 0:
+            return seq, b''
+
+        if self._chunk is None or len(self._chunk) < n * RECORD_SIZE:
+            self._chunk = memoryview(bytearray(max_records * RECORD_SIZE))
+        chunk = self._chunk[:n * RECORD_SIZE]
+        try:
+            with open(self._path(segment), 'rb') as f:
+                f.seek(slot * RECORD_SIZE)
+                got = f.readinto(chunk)
+        except OSError:
+            got = 0
+        if not got:
+            # segment is gone, skip it
+            skipped = (segment + 1) * self.segment_records - seq
+            self.lost += skipped
+            self.ack(seq + skipped)
+            return seq, b''
+        return seq, chunk[:got - got % RECORD_SIZE]
+
+    def ack(self, seq):
+        """Records before `seq` were uploaded."""
+        self.cursor = seq
+        self._save('.cur', seq)
@@ -0,0 +1,122 @@
+# Flood protection for handle_auth.
+#
+# DecisionCache remembers the last few lookups (digest -> granted) for a
+# while, so a card and PIN tried again and again is answered from RAM. It is
+# emptied whenever the HashStore starts a new generation.
+#
+# RateLimiter keeps a token bucket per card UID. Every attempt takes a token,
+# tokens come back one per refill_ms up to burst, and a card without tokens
+# is turned away before the PIN is asked for and anything is hashed.
+#
+# Both have a fixed number of slots. DecisionCache reuses the least recently
+# used one, RateLimiter the one with the most tokens: a full bucket is no
+# different from a new one, and a card being throttled keeps its slot however
+# many other cards are tapped.
+
+import utime
+
+
+class DecisionCache:
+    def __init__(self, db, size=16, ttl_ms=60000):
+        self._db = db
+        self.size = size
+        self.ttl_ms = ttl_ms
+        self.hits = 0
+        self._generation = db.generation
+        self._keys = [None] * size
+        self._found = [False] * size
+        self._used = [0] * size
+
+    def clear(self):
+        for i in range(self.size):
+            self._keys[i] = None
+
+    def __contains__(self, digest):
+        return self.contains(digest)
+
+    def contains(self, digest):
+        if self._generation != self._db.generation:
+            self._generation = self._db.generation
+            self.clear()
+
+        now = utime.ticks_ms()
+        keys = self._keys
+        used = self._used
+        oldest = 0
+        for i in range(self.size):
+            k = keys[i]
+            if k is None or utime.ticks_diff(now, used[i]) > self.ttl_ms:
+                keys[i] = None
+                oldest = i
+                continue
+            if k == digest:
+                used[i] = now
+                self.hits += 1
+                return self._found[i]
+            if keys[oldest] is not None and utime.ticks_diff(used[oldest], used[i]) > 0:
+                oldest = i
+
+        found = digest in self._db
+        keys[oldest] = bytes(digest)
+        self._found[oldest] = found
+        used[oldest] = now
+        return found
+
+
+class RateLimiter:
+    def __init__(self, burst=5, refill_ms=10000, size=16):
+        self.burst = burst
+        self.refill_ms = refill_ms
+        self.size = size
+        self.throttled = 0
+        self._keys = [None] * size
+        self._tokens = [0] * size
+        self._last = [0] * size
+        self._denied = [0] * size
+
+    def _slot(self, key, now):
+        keys = self._keys
+        last = self._last
+        burst = self.burst
+        # free slots first, then the most tokens, then the closest to the
+        # next one
+        free = 0
+        most = -1
+        for i in range(self.size):
+            if keys[i] == key:
+                return i
+            if keys[i] is None:
+                tokens = burst + 1
+            else:
+                tokens = min(burst, self._tokens[i] + utime.ticks_diff(now, last[i]) // self.refill_ms)
+            if tokens > most or (tokens == most and utime.ticks_diff(last[free], last[i]) > 0):
+                free = i
+                most = tokens
+        keys[free] = bytes(key)
+        self._tokens[free] = burst
+        last[free] = now
+        self._denied[free] = 0
+        return free
+
+    def check(self, key):
+        """
+        Take a token for `key`. Returns 0 when the attempt may go ahead,
+        otherwise how many attempts of this burst were turned away so far.
+        """
+        now = utime.ticks_ms()
+        i = self._slot(key, now)
+        # whole tokens earned since the last refill
+        earned = utime.ticks_diff(now, self._last[i]) // self.refill_ms
+        if earned:
+            self._tokens[i] = min(self.burst, self._tokens[i] + earned)
+            self._last[i] = utime.ticks_add(self._last[i], earned * self.refill_ms)
+        if self._tokens[i] >= self.burst:
+            self._last[i] = now
+
+        if self._tokens[i]:
+            self._tokens[i] -= 1
+            self._denied[i] = 0
+            return 0
+        self._denied[i] += 1
+        self.throttled += 1
+        return self._denied[i]
@@ -0,0 +1,43 @@
+# Card credentials: how a card UID and a PIN become the digest stored in the
+# hash database.
+#
+# Shared by the lock and the host tools (tools/hashdb_compile.py), so it must
+# only use modules that exist in both MicroPython and CPython. Changing any of
+# this invalidates every enrolled user.
+
+import hashlib
+
+CARD_MIFARE = 'mifare'
+CARD_ANDROID = 'android'
+
+
+def hce_uid(data):
+    """
+    UID string from the HCE app's answer to SELECT AID: the bytes as text if
+    they are ascii, otherwise their hex.
+    """
+    data = bytes(data)
+    try:
+        return data.decode('ascii')
+    except Exception:
+        return data.hex()
+
+
+def uid_bytes(card_type, card_uid):
+    """The UID bytes that go into the hash for a card of `card_type`."""
+    if card_type == CARD_ANDROID:
+        try:
+            return bytes.fromhex(card_uid)
+        except Exception:
+            return card_uid.encode() if isinstance(card_uid, str) else card_uid
+    return card_uid
+
+
+def generate_digest(card_uid, pin):
+    card_uid = bytes(reversed(card_uid[:4])).hex()
+    s = "{:08x}:{}".format(int(pin), card_uid)
+    return hashlib.sha256(s.encode('ascii')).digest()
+
+
+def generate_hash(card_uid, pin):
+    return generate_digest(card_uid, pin).hex()
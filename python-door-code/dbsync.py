@@ -0,0 +1,310 @@
+# Versioned hash database sync.
+#
+# The lock requests  GET <url>?since=<local version>  and the server answers
+# with one of:
+#
+#   304                                       already up to date
+#   200 application/x-hashdb-delta            added/removed digests
+#   200 application/x-hashdb+deflate          zlib compressed hashes.db
+#   200 text/plain                            legacy hex-lines file
+#
+# Delta body (little endian): magic "MHDD", format (u8), reserved (3 bytes),
+# base version (u32), version (u32), added count (u32), removed count (u32),
+# followed by the sorted added and then the sorted removed digests. A delta is
+# only applied on top of the base version it was computed against.
+#
+# The body is streamed to a download file through one reusable buffer while a
+# SHA-256 over it is updated, and checked against the X-Hashdb-Sha256 header
+# before anything is applied. The new database is then built next to the live
+# one with a DBWriter, which writes the lookup index as the digests go by,
+# and handed to HashStore.swap(). RAM use does not depend on the size of the
+# database, and a failed or interrupted sync leaves the old generation intact.
+
+import os
+import struct
+import asyncio
+import hashlib
+import hashdb
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+import zlib
+
+DELTA_MAGIC = b'MHDD'
+DELTA_HEADER_SIZE = 24
+
+CONTENT_DELTA = 'application/x-hashdb-delta'
+CONTENT_SNAPSHOT = 'application/x-hashdb+deflate'
+# hex SHA-256 of the response body
+DIGEST_HEADER = 'x-hashdb-sha256'
+
+_CHUNK = 512
+# seconds without data before the download is given up
+_TIMEOUT = 10
+# digests merged between yields to the event loop
+_YIELD_EVERY = 64
+
+
+class SyncError(Exception):
+    pass
+
+
+class BaseMismatch(SyncError):
+    pass
+
+
+class _Inflater:
+    """Wraps CPython's zlib so it offers the same read() as DeflateIO."""
+    def __init__(self, stream):
+        self._stream = stream
+        self._z = zlib.decompressobj()
+        self._buf = b''
+
+    def read(self, n):
+        while len(self._buf) < n:
+            chunk = self._stream.read(_CHUNK)
+            if not chunk:
+                self._buf += self._z.flush()
+                break
+            self._buf += self._z.decompress(chunk)
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+
+def inflate_stream(stream):
+    if deflate is not None:
+        return deflate.DeflateIO(stream, deflate.ZLIB)
+    if hasattr(zlib, 'DecompIO'):
+        return zlib.DecompIO(stream, 15)
+    return _Inflater(stream)
+
+
+def _read_exact(stream, n):
+    data = b''
+    while len(data) < n:
+        chunk = stream.read(n - len(data))
+        if not chunk:
+            raise SyncError('truncated response')
+        data += chunk
+    return data
+
+
+def _read_digest(f, buf):
+    if f.readinto(buf) != hashdb.DIGEST_SIZE:
+        raise SyncError('truncated response')
+    return buf
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+async def _readinto(reader, buf):
+    # MicroPython streams fill the buffer in place, CPython ones only read()
+    if hasattr(reader, 'readinto'):
+        return await asyncio.wait_for(reader.readinto(buf), _TIMEOUT)
+    data = await asyncio.wait_for(reader.read(len(buf)), _TIMEOUT)
+    buf[:len(data)] = data
+    return len(data)
+
+
+async def download(reader, path, length=None):
+    """
+    Stream the rest of the response into `path`. Returns the number of bytes
+    and the SHA-256 of the body.
+    """
+    buf = bytearray(_CHUNK)
+    mv = memoryview(buf)
+    h = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as f:
+        while True:
+            n = await _readinto(reader, buf)
+            if not n:
+                break
+            h.update(mv[:n])
+            f.write(mv[:n])
+            size += n
+    if length is not None and size != length:
+        raise SyncError('truncated response')
+    return size, h.digest()
+
+
+async def apply_snapshot(src, path):
+    """Rebuild the compressed database in `src` at `path`."""
+    with open(src, 'rb') as raw:
+        stream = inflate_stream(raw)
+        header = _read_exact(stream, hashdb.HEADER_SIZE)
+        magic, fmt, size, _, count, version = struct.unpack(hashdb._HEADER_FMT, header)
+        if magic != hashdb.MAGIC or fmt != hashdb.FORMAT or size != hashdb.DIGEST_SIZE:
+            raise SyncError('bad snapshot header')
+        # the index is rebuilt by the writer
+        _read_exact(stream, hashdb.INDEX_SIZE)
+
+        with hashdb.DBWriter(path, version) as w:
+            for i in range(count):
+                w.add(_read_exact(stream, hashdb.DIGEST_SIZE))
+                if i % _YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+    return version
+
+
+async def apply_delta(src, live, path):
+    """Merge the delta in `src` with the live database into `path`."""
+    with open(src, 'rb') as f:
+        header = f.read(DELTA_HEADER_SIZE)
+        if len(header) != DELTA_HEADER_SIZE:
+            raise SyncError('truncated response')
+        magic, fmt, base, version, n_added, n_removed = struct.unpack('<4sB3xIIII', header)
+    if magic != DELTA_MAGIC or fmt != 1:
+        raise SyncError('bad delta header')
+    if os.stat(src)[6] != DELTA_HEADER_SIZE + (n_added + n_removed) * hashdb.DIGEST_SIZE:
+        raise SyncError('bad delta size')
+
+    with hashdb.HashDB(live) as old:
+        if old.version != base:
+            raise BaseMismatch('delta base {} does not match local version {}'.format(base, old.version))
+
+        # added and removed are both sorted, so old, added and removed are
+        # merged in one pass with a file position for each list
+        fa = open(src, 'rb')
+        fr = open(src, 'rb')
+        try:
+            fa.seek(DELTA_HEADER_SIZE)
+            fr.seek(DELTA_HEADER_SIZE + n_added * hashdb.DIGEST_SIZE)
+            a = _read_digest(fa, bytearray(hashdb.DIGEST_SIZE)) if n_added else None
+            r = _read_digest(fr, bytearray(hashdb.DIGEST_SIZE)) if n_removed else None
+
+            with hashdb.DBWriter(path, version) as w:
+                i = 0
+                for d in old:
+                    while a is not None and hashdb._cmp(a, d) < 0:
+                        w.add(a)
+                        n_added -= 1
+                        a = _read_digest(fa, a) if n_added else None
+                    while r is not None and hashdb._cmp(r, d) < 0:
+                        n_removed -= 1
+                        r = _read_digest(fr, r) if n_removed else None
+                    if r is None or hashdb._cmp(r, d) != 0:
+                        w.add(d)
+                    i += 1
+                    if i % _YIELD_EVERY == 0:
+                        await asyncio.sleep(0)
+                while a is not None:
+                    w.add(a)
+                    n_added -= 1
+                    a = _read_digest(fa, a) if n_added else None
+        finally:
+            fa.close()
+            fr.close()
+    return version
+
+
+def apply_legacy(src, path):
+    # unsorted text without a version, this one has to be sorted in RAM
+    hashdb.convert_hex_lines(src, path)
+    return 0
+
+
+def _split_url(url):
+    if not url.startswith('http://'):
+        raise SyncError('unsupported url {}'.format(url))
+    host, _, path = url[7:].partition('/')
+    host, _, port = host.partition(':')
+    return host, int(port) if port else 80, '/' + path
+
+
+async def _get(url):
+    """Send a GET request, returns (status, headers, reader, writer)."""
+    host, port, path = _split_url(url)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), _TIMEOUT)
+    try:
+        writer.write('GET {} HTTP/1.0\r\nHost: {}\r\n\r\n'.format(path, host).encode())
+        await writer.drain()
+        line = await asyncio.wait_for(reader.readline(), _TIMEOUT)
+        try:
+            status = int(line.split(None, 2)[1])
+        except (IndexError, ValueError):
+            raise SyncError('bad status line')
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), _TIMEOUT)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode().partition(':')
+            headers[k.strip().lower()] = v.strip()
+    except Exception:
+        writer.close()
+        raise
+    return status, headers, reader, writer
+
+
+async def sync(url, store):
+    """
+    Bring the database of the HashStore `store` up to date with the server.
+    Returns the new version and how it was fetched: 'current', 'delta',
+    'snapshot' or 'legacy'.
+    """
+    version = hashdb.db_version(store.path)
+    try:
+        return await _fetch(url, store, version)
+    except BaseMismatch as e:
+        # our database is not what the server thinks it is, start over
+        print('sync: {}, fetching snapshot'.format(e))
+        return await _fetch(url, store, 0)
+
+
+async def _fetch(url, store, version):
+    live = store.path
+    dl = live + '.dl'
+    new = live + '.new'
+
+    status, headers, reader, writer = await _get('{}?since={}'.format(url, version))
+    try:
+        if status == 304:
+            return version, 'current'
+        if not 200 <= status < 300:
+            raise SyncError('http status {}'.format(status))
+
+        length = headers.get('content-length')
+        size, digest = await download(reader, dl, int(length) if length else None)
+    except Exception:
+        _remove(dl)
+        raise
+    finally:
+        writer.close()
+
+    try:
+        kind = headers.get('content-type', '').split(';')[0].strip()
+        expected = headers.get(DIGEST_HEADER)
+        if expected is not None:
+            if digest.hex() != expected.lower():
+                raise SyncError('digest mismatch')
+        elif kind in (CONTENT_DELTA, CONTENT_SNAPSHOT):
+            raise SyncError('missing {} header'.format(DIGEST_HEADER))
+        else:
+            print('sync: legacy response is not signed with a digest')
+        print('sync: {} bytes verified'.format(size))
+
+        if kind == CONTENT_DELTA:
+            mode = 'delta'
+            version = await apply_delta(dl, live, new)
+        elif kind == CONTENT_SNAPSHOT:
+            mode = 'snapshot'
+            version = await apply_snapshot(dl, new)
+        else:
+            mode = 'legacy'
+            version = apply_legacy(dl, new)
+
+        await store.swap(new)
+    except Exception:
+        _remove(new)
+        raise
+    finally:
+        _remove(dl)
+    return version, mode
@@ -0,0 +1,132 @@
+# Bounded event queue for Net.
+#
+# Events are kept in a fixed size ring in FIFO order. When the ring is full the
+# overflow policy decides what gives:
+#
+#   DROP_OLDEST  the oldest event is dropped
+#   COALESCE     the newest queued event with the same name takes the new
+#                payload, if there is none the oldest event is dropped
+#
+# Events that are being published (hold() until release()) are never dropped
+# or coalesced, so discard() afterwards removes exactly what was sent. If all
+# queued events are in flight, the new one is dropped.
+#
+# Several events can be published as one MQTT message. A batch is a sequence
+# of records: name length (u8), name, payload length (u16 LE), payload.
+
+
+class EventQueue:
+    DROP_OLDEST = 'drop-oldest'
+    COALESCE = 'coalesce'
+
+    def __init__(self, capacity=64, policy=DROP_OLDEST):
+        self.capacity = capacity
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+
+        self._names = [None] * capacity
+        self._payloads = [None] * capacity
+        self._head = 0
+        self._count = 0
+        # the oldest _inflight events are being published
+        self._inflight = 0
+
+    def __len__(self):
+        return self._count
+
+    def stats(self):
+        return {
+            'queued': self._count,
+            'capacity': self.capacity,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+    def put(self, name, payload):
+        cap = self.capacity
+        if self._count == cap:
+            held = self._inflight
+            if self.policy == self.COALESCE:
+                for i in range(self._count - 1, held - 1, -1):
+                    j = (self._head + i) % cap
+                    if self._names[j] == name:
+                        self._payloads[j] = payload
+                        self.coalesced += 1
+                        return
+            self.dropped += 1
+            if held == self._count:
+                return
+            # drop the oldest event that is not in flight
+            for i in range(held, self._count - 1):
+                j = (self._head + i) % cap
+                k = (j + 1) % cap
+                self._names[j] = self._names[k]
+                self._payloads[j] = self._payloads[k]
+            self._count -= 1
+
+        j = (self._head + self._count) % cap
+        self._names[j] = name
+        self._payloads[j] = payload
+        self._count += 1
+
+    def peek(self):
+        """Return the oldest event as (name, payload), or None."""
+        if not self._count:
+            return None
+        return self._names[self._head], self._payloads[self._head]
+
+    def hold(self, n):
+        """Mark the n oldest events as in flight until release()."""
+        self._inflight = min(n, self._count)
+
+    def release(self):
+        self._inflight = 0
+
+    def discard(self, n):
+        """Remove the n oldest events, once they were published."""
+        n = min(n, self._count)
+        cap = self.capacity
+        for _ in range(n):
+            self._names[self._head] = None
+            self._payloads[self._head] = None
+            self._head = (self._head + 1) % cap
+        self._count -= n
+        self._inflight = max(0, self._inflight - n)
+
+    def encode_batch(self, max_bytes=1024):
+        """
+        Encode as many of the oldest events as fit in max_bytes (at least one)
+        and return (count, payload). The events stay queued until discard().
+        """
+        out = bytearray()
+        n = 0
+        cap = self.capacity
+        while n < self._count:
+            j = (self._head + n) % cap
+            name = self._names[j].encode()
+            payload = self._payloads[j]
+            size = 3 + len(name) + len(payload)
+            if n and len(out) + size > max_bytes:
+                break
+            out.append(len(name))
+            out += name
+            out.append(len(payload) & 0xFF)
+            out.append(len(payload) >> 8)
+            out += payload
+            n += 1
+        return n, out
+
+
+def decode_batch(data):
+    """Decode a batch payload into a list of (name, payload) tuples."""
+    events = []
+    i = 0
+    while i < len(data):
+        n = data[i]
+        name = bytes(data[i+1:i+1+n]).decode()
+        i += 1 + n
+        size = data[i] | (data[i+1] << 8)
+        events.append((name, bytes(data[i+2:i+2+size])))
+        i += 2 + size
+    return events
@@ -0,0 +1,445 @@
+# Compact on-device hash database.
+#
+# Layout (all integers little endian):
+#
+#   header   16 bytes   magic "MHDB", format (u8), digest size (u8),
+#                       reserved (u16), count (u32), version (u32)
+#   index    1024 bytes 256 x u32, index[b] is the position of the first
+#                       digest whose first byte is >= b
+#   digests  count x 32 sorted raw SHA-256 digests
+#
+# A lookup reads two index entries to find the bucket for the first byte of
+# the digest and then binary searches the bucket with seek + readinto into a
+# preallocated buffer, so nothing is allocated per probed entry.
+
+import os
+import struct
+import asyncio
+
+MAGIC = b'MHDB'
+FORMAT = 1
+DIGEST_SIZE = 32
+HEADER_SIZE = 16
+INDEX_SIZE = 256 * 4
+DATA_OFFSET = HEADER_SIZE + INDEX_SIZE
+
+_HEADER_FMT = '<4sBBHII'
+
+
+class HashDBError(ValueError):
+    pass
+
+
+def _u32(buf, offset):
+    return buf[offset] | (buf[offset+1] << 8) | (buf[offset+2] << 16) | (buf[offset+3] << 24)
+
+
+def _cmp(buf, digest):
+    """Compare a digest read from flash with the one we are looking for."""
+    for i in range(DIGEST_SIZE):
+        a = buf[i]
+        b = digest[i]
+        if a != b:
+            return -1 if a < b else 1
+    return 0
+
+
+class HashDB:
+    """
+    Read only view of a hash database file. Keep the instance around between
+    lookups, opening the file and parsing the header is the expensive part.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        try:
+            header = self._f.read(HEADER_SIZE)
+            if len(header) != HEADER_SIZE:
+                raise HashDBError('truncated header')
+            magic, fmt, size, _, count, version = struct.unpack(_HEADER_FMT, header)
+            if magic != MAGIC:
+                raise HashDBError('bad magic')
+            if fmt != FORMAT or size != DIGEST_SIZE:
+                raise HashDBError('unsupported format')
+        except Exception:
+            self._f.close()
+            raise
+
+        self.count = count
+        self.version = version
+        self._idx = bytearray(8)
+        self._buf = bytearray(DIGEST_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        return self.contains(digest)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def _bucket(self, first):
+        f = self._f
+        idx = self._idx
+        f.seek(HEADER_SIZE + first * 4)
+        f.readinto(idx)
+        if first == 255:
+            return _u32(idx, 0), self.count
+        return _u32(idx, 0), _u32(idx, 4)
+
+    def contains(self, digest):
+        """Return True if the raw 32 byte digest is in the database."""
+        if len(digest) != DIGEST_SIZE:
+            return False
+
+        lo, hi = self._bucket(digest[0])
+        f = self._f
+        buf = self._buf
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            f.seek(DATA_OFFSET + mid * DIGEST_SIZE)
+            f.readinto(buf)
+            c = _cmp(buf, digest)
+            if c == 0:
+                return True
+            if c < 0:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def __iter__(self):
+        f = self._f
+        f.seek(DATA_OFFSET)
+        for _ in range(self.count):
+            yield f.read(DIGEST_SIZE)
+
+
+# Rough RAM cost of one digest held in a set: the bytes object plus its slot.
+_SET_ENTRY_COST = 64
+# digests read between yields to the event loop while swap() builds a cache
+_YIELD_EVERY = 256
+
+
+# The digests are uniformly distributed already, so the probe positions
+# are taken straight from 24 bit slices of the digest.
+def _bloom_add(bloom, bits, k, digest):
+    for i in range(k):
+        o = 3 * i + 1
+        h = (digest[o] | (digest[o+1] << 8) | (digest[o+2] << 16)) % bits
+        bloom[h >> 3] |= 1 << (h & 7)
+
+
+def _bloom_check(bloom, bits, k, digest):
+    for i in range(k):
+        o = 3 * i + 1
+        h = (digest[o] | (digest[o+1] << 8) | (digest[o+2] << 16)) % bits
+        if not bloom[h >> 3] & (1 << (h & 7)):
+            return False
+    return True
+
+
+class HashStore:
+    """
+    Membership layer in front of a HashDB. When the database fits in
+    `mem_budget` bytes all digests are kept in a set and flash is never
+    touched. Otherwise a Bloom filter of at most `mem_budget` bytes rejects
+    most unknown digests and only possible hits are confirmed on flash.
+
+    The cache is built on the first lookup, or by load(). A new database is
+    installed with swap(), which builds the cache for it in steps between
+    other tasks before the live file is touched. Call invalidate() instead
+    when the file was replaced behind our back, the cache is rebuilt on the
+    next lookup.
+    """
+    def __init__(self, path, mem_budget=16 * 1024):
+        self.path = path
+        self.mem_budget = mem_budget
+        self.generation = 0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.false_positives = 0
+
+        self._loaded = -1
+        self._db = None
+        self._set = None
+        self._bloom = None
+        self._bits = 0
+        self._k = 0
+
+    def invalidate(self):
+        self.generation += 1
+
+    def load(self):
+        """Open the database and build its cache now, not on the first lookup."""
+        if self._loaded != self.generation:
+            self._load()
+
+    def stats(self):
+        return {
+            'generation': self.generation,
+            'version': self.version,
+            'mode': 'set' if self._set is not None else 'bloom' if self._bloom is not None else 'empty',
+            'hits': self.hits,
+            'misses': self.misses,
+            'false_positives': self.false_positives,
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _build(self, path):
+        """
+        Read the database at `path` into a new cache. A generator that yields
+        every _YIELD_EVERY digests and returns the open HashDB (None in set
+        mode), set, bloom filter, bits, probe count and version.
+        """
+        db = HashDB(path)
+        try:
+            n = db.count
+            if n * _SET_ENTRY_COST <= self.mem_budget:
+                digests = set()
+                i = 0
+                for d in db:
+                    digests.add(d)
+                    i += 1
+                    if i % _YIELD_EVERY == 0:
+                        yield
+                db.close()
+                return None, digests, None, 0, 0, db.version
+
+            # size the filter to the budget, ~0.69 * bits / n probes is optimal
+            bits = self.mem_budget * 8
+            if bits > 1 << 24:
+                bits = 1 << 24
+            k = (bits * 69) // (n * 100)
+            k = 1 if k < 1 else 8 if k > 8 else k
+            bloom = bytearray(bits // 8)
+            i = 0
+            for d in db:
+                _bloom_add(bloom, bits, k, d)
+                i += 1
+                if i % _YIELD_EVERY == 0:
+                    yield
+            return db, None, bloom, bits, k, db.version
+        except BaseException:
+            # also when the build is abandoned half way
+            db.close()
+            raise
+
+    def _install(self, cache):
+        self._db, self._set, self._bloom, self._bits, self._k, self.version = cache
+        self._loaded = self.generation
+
+    def _load(self):
+        self.close()
+        self._set = None
+        self._bloom = None
+        self._loaded = self.generation
+
+        build = self._build(self.path)
+        try:
+            while True:
+                next(build)
+        except StopIteration as e:
+            self._install(e.value)
+        except (OSError, HashDBError) as e:
+            print('hashdb: cannot open {}: {}'.format(self.path, e))
+
+    async def swap(self, new_path):
+        """
+        Replace the live database with the file at `new_path` and start a new
+        generation. The new cache is built first, yielding to the event loop
+        every _YIELD_EVERY digests, so a bad file (or a failed rename) raises
+        and leaves the current generation in place. Lookups meanwhile answer
+        from the old generation. The finished cache is installed without
+        yielding, so the next lookup sees only the new generation.
+        """
+        build = self._build(new_path)
+        try:
+            while True:
+                next(build)
+                await asyncio.sleep(0)
+        except StopIteration as e:
+            cache = e.value
+        finally:
+            build.close()
+        db = cache[0]
+        if db is not None:
+            # the file is renamed below, reopen it under its final name
+            db.close()
+        self.close()
+        try:
+            os.rename(new_path, self.path)
+        except OSError:
+            # the old generation stays, a Bloom filter needs its file open
+            # again to confirm hits
+            if self._bloom is not None:
+                self._db = HashDB(self.path)
+            raise
+        if db is not None:
+            cache = (HashDB(self.path),) + cache[1:]
+        self.generation += 1
+        self._install(cache)
+
+    def __contains__(self, digest):
+        return self.contains(digest)
+
+    def contains(self, digest):
+        if self._loaded != self.generation:
+            self._load()
+
+        if self._set is not None:
+            found = digest in self._set
+        elif self._bloom is not None:
+            found = _bloom_check(self._bloom, self._bits, self._k, digest)
+            if found:
+                found = self._db.contains(digest)
+                if not found:
+                    self.false_positives += 1
+        else:
+            found = False
+
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+
+class DBWriter:
+    """
+    Streaming writer for a database file. Digests must be added in ascending
+    order, the first-byte index is built as they arrive and written together
+    with the header by close(). The file is written next to the destination
+    and renamed over it, so readers never see a half written database.
+    """
+    def __init__(self, path, version=0):
+        self.path = path
+        self.version = version
+        self.count = 0
+        self._tmp = path + '.tmp'
+        self._f = open(self._tmp, 'wb')
+        self._index = bytearray(INDEX_SIZE)
+        self._next = 0
+        self._last = None
+        # placeholder header and index, filled in by close()
+        self._f.write(self._index[:HEADER_SIZE])
+        self._f.write(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, digest):
+        if len(digest) != DIGEST_SIZE:
+            raise HashDBError('digest must be {} bytes'.format(DIGEST_SIZE))
+        if self._last is not None:
+            c = _cmp(self._last, digest)
+            if c == 0:
+                return
+            if c > 0:
+                raise HashDBError('digests must be added in ascending order')
+        else:
+            self._last = bytearray(DIGEST_SIZE)
+
+        while self._next <= digest[0]:
+            struct.pack_into('<I', self._index, self._next * 4, self.count)
+            self._next += 1
+        self._f.write(digest)
+        self._last[:] = digest
+        self.count += 1
+
+    def close(self):
+        while self._next < 256:
+            struct.pack_into('<I', self._index, self._next * 4, self.count)
+            self._next += 1
+        f = self._f
+        f.seek(0)
+        f.write(struct.pack(_HEADER_FMT, MAGIC, FORMAT, DIGEST_SIZE, 0, self.count, self.version))
+        f.write(self._index)
+        f.close()
+        os.rename(self._tmp, self.path)
+
+    def abort(self):
+        self._f.close()
+        try:
+            os.remove(self._tmp)
+        except OSError:
+            pass
+
+
+def write_db(path, digests, version=0):
+    """Write a database file from an iterable of raw digests."""
+    with DBWriter(path, version) as w:
+        for d in sorted(set(bytes(d) for d in digests)):
+            w.add(d)
+    return w.count
+
+
+def db_version(path):
+    """Return the version stored in a database file, 0 if there is none."""
+    try:
+        with HashDB(path) as db:
+            return db.version
+    except (OSError, HashDBError):
+        return 0
+
+
+def read_hex_lines(path):
+    """Parse the legacy text format: one hex encoded SHA-256 per line."""
+    digests = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                d = bytes.fromhex(line)
+            except ValueError:
+                print('hashdb: skipping malformed line')
+                continue
+            if len(d) != DIGEST_SIZE:
+                print('hashdb: skipping malformed line')
+                continue
+            digests.append(d)
+    return digests
+
+
+def convert_hex_lines(src, dst, version=0):
+    """Convert a legacy hex-lines `hashes` file into the binary format."""
+    return write_db(dst, read_hex_lines(src), version)
+
+
+def is_db(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        print('usage: hashdb.py <hashes> <hashes.db>')
+        sys.exit(1)
+    n = convert_hex_lines(sys.argv[1], sys.argv[2])
+    print('wrote {} digests to {}'.format(n, sys.argv[2]))
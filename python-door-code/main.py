@@ -1,16 +1,103 @@
-from pn532 import PN532Uart, PN532Error
+# before anything else, for the startup timing
 import utime
+_START = utime.ticks_ms()
+
+from pn532 import AsyncPN532Uart, PN532Error
+from hashdb import HashStore
+from events import EventQueue
+from metrics import Metrics
+from memstats import IdleGC, MemStats
+from authcache import DecisionCache, RateLimiter
+from accesslog import AccessLog
+import accesslog
+import hashdb
+from credentials import generate_digest, uid_bytes, CARD_MIFARE, CARD_ANDROID
 import machine
-import hashlib
-import os
+import json
+import random
 import asyncio
-import network
-import requests
-import _thread
-from umqtt.simple import MQTTClient
+# network, mqtt_async and dbsync are imported by Net once the doors are up
 
 DEBUG = True
 
+HASHES_FILE = 'hashes'
+HASHDB_FILE = 'hashes.db'
+# RAM the membership cache may use before it falls back to a Bloom filter
+HASHDB_CACHE_BYTES = 16 * 1024
+# TODO: add auth support to http server
+SYNC_URL = "http://10.11.1.1:8000/hashes/internal"
+# On `sync` a lock waits a random 0..SYNC_SPREAD seconds before downloading, so
+# a fleet wide sync does not hit the server all at once. `sync <seconds>`
+# overrides it.
+SYNC_SPREAD = 0
+MQTT_BROKER = "10.11.1.1"
+# The clock is set from this NTP server once the network is up, access log
+# records get no time before that
+NTP_HOST = "pool.ntp.org"
+# Nfc.MODE_POLL or Nfc.MODE_AUTOPOLL, see Nfc
+NFC_MODE = 'poll'
+# Events waiting for the broker, and what to do when the queue is full
+EVENT_QUEUE_SIZE = 64
+EVENT_QUEUE_POLICY = EventQueue.DROP_OLDEST
+# Queued events are published together in batches of up to this many bytes
+EVENT_BATCH_BYTES = 1024
+# MQTT reconnect backoff in seconds, doubled after every failed attempt
+MQTT_BACKOFF_MIN = 1
+MQTT_BACKOFF_MAX = 60
+# With DEBUG on, latency histograms are published to locks/internal/metrics
+# this often (seconds)
+METRICS_INTERVAL = 60
+# One pipeline per door: a PN532 reader and a keypad, both (uart, tx pin, rx
+# pin), and the lock pin. Every door has its own tasks, all doors share the
+# hash database and the MQTT connection. With a name set the door's events
+# go to locks/internal/events/<event>/<name>. The ESP32 has UARTs 0-2 and 0
+# is the REPL, so it drives one door; more doors need a board with more UARTs.
+DOORS = [
+    {'name': None, 'reader': (2, 22, 19), 'keypad': (1, 16, 17), 'lock': 2},
+]
+# Seconds between attempts to bring up a reader that does not answer
+READER_RETRY = 10
+# UART baud rate the readers are switched to at startup (up to 1288000). If a
+# reader does not answer at this rate it stays at 115200.
+READER_BAUDRATE = 115200
+# Seconds the door stays unlocked, and the keypad shows a denial. Another
+# grant while the door is unlocked extends the time.
+UNLOCK_TIME = 2
+DENY_TIME = 0.5
+# Taps waiting for the keypad: at most TAP_QUEUE, dropped when older than
+# TAP_MAX_AGE_MS
+TAP_QUEUE = 4
+TAP_MAX_AGE_MS = 15000
+# Recent lookups answered from RAM: slots and how long they are valid (ms)
+AUTH_CACHE_SIZE = 16
+AUTH_CACHE_TTL_MS = 60000
+# Attempts per card: a burst of AUTH_BURST, then one per AUTH_REFILL_MS
+AUTH_BURST = 5
+AUTH_REFILL_MS = 10000
+# Access decisions are logged to flash in LOG_SEGMENTS files of
+# LOG_SEGMENT_RECORDS records (32 bytes each), written every LOG_FLUSH_INTERVAL
+# seconds, and uploaded to locks/internal/log LOG_UPLOAD_RECORDS at a time
+ACCESS_LOG = 'access'
+LOG_SEGMENTS = 4
+LOG_SEGMENT_RECORDS = 512
+LOG_FLUSH_INTERVAL = 10
+LOG_UPLOAD_RECORDS = 32
+# A PIN typed at most this long (ms) before the card is presented is used,
+# 0 requires the card first
+PIN_TYPEAHEAD_MS = 0
+# Net waits this long (s) for the readers before bringing up the network anyway
+NET_START_DELAY = 5
+# A card on the reader is checked for this often (s) until it is taken away
+PRESENCE_INTERVAL = 0.2
+# The poll loop runs gc.collect in its idle gaps at most this often (ms)
+GC_IDLE_INTERVAL_MS = 5000
+# Record what each hot path allocates, reported by `stats`. Off in normal
+# use: gc.mem_alloc and gc.mem_free walk the whole heap on every call.
+MEM_STATS = False
+# Abandon the PIN entry when the card is taken away before the PIN is
+# complete. Off: the card may be taken away once it was read.
+PIN_NEEDS_CARD = False
+
 class Keypad:
     CMD_RESET = 'F'
     CMD_ENABLE_FEEDBACK = 'Q'
@@ -19,125 +106,304 @@ class Keypad:
     CMD_GRANTED = 'H' # AKA happy
     CMD_DENIED = 'S' # AKA sad
 
-    def __init__(self, uart):
+    PIN_LENGTH = 4
+
+    def __init__(self, uart, typeahead_ms=0):
         self._uart = uart
+        self._sreader = asyncio.StreamReader(uart)
+        self._digits = bytearray()
+        self._last = utime.ticks_ms()
+        self._flag = asyncio.Event()
+        self._cancelled = False
+        # digits typed at most this long before get_pin() count towards the PIN
+        self.typeahead_ms = typeahead_ms
 
     def write(self, data):
         self._uart.write(data)
         self._uart.flush()
 
-    async def get_pin(self, timeout_ms=10000):
-        uart = self._uart
+    async def loop(self):
+        # Turn the keypad's bytes into digits as they arrive, anything but a
+        # digit is ignored. Only the newest PIN_LENGTH digits are kept.
+        buf = bytearray(16)
+        digits = self._digits
+        while True:
+            n = await self._sreader.readinto(buf)
+            for i in range(n):
+                c = buf[i]
+                if ord('0') <= c <= ord('9'):
+                    if len(digits) == self.PIN_LENGTH:
+                        digits[:] = digits[1:]
+                    digits.append(c)
+                    self._last = utime.ticks_ms()
+                    self._flag.set()
 
-        # discard previous bytes
-        uart.read(uart.any())
+    async def get_pin(self, timeout_ms=10000):
+        digits = self._digits
+        # drop what was typed before the card, unless it was just now
+        if not self.typeahead_ms or utime.ticks_diff(utime.ticks_ms(), self._last) > self.typeahead_ms:
+            digits[:] = b''
 
+        uart = self._uart
         uart.write(self.CMD_ENABLE_FEEDBACK)
         uart.write(self.CMD_LED_GREEN)
         uart.flush()
 
-        data = bytearray()
-        while len(data) < 4 and timeout_ms > 0:
-            n = uart.any()
-            for c in uart.read(n):
-                if ord('0') <= c <= ord('9'):
-                    # print(f"rx: {c}")
-                    data.append(c)
-            await asyncio.sleep(0.1)
-            timeout_ms -= 100
+        # done the moment the last digit arrives
+        self._cancelled = False
+        deadline = utime.ticks_add(utime.ticks_ms(), timeout_ms)
+        while len(digits) < self.PIN_LENGTH and not self._cancelled:
+            remaining = utime.ticks_diff(deadline, utime.ticks_ms())
+            if remaining <= 0:
+                break
+            self._flag.clear()
+            try:
+                await asyncio.wait_for(self._flag.wait(), remaining / 1000)
+            except asyncio.TimeoutError:
+                break
 
-        return data[:4]
+        pin = bytes(digits)
+        digits[:] = b''
+        return pin
+
+    def cancel(self):
+        """End a running get_pin() early, it returns what was typed so far."""
+        self._cancelled = True
+        self._flag.set()
 
 
 class Net:
-    def __init__(self):
+    def __init__(self, db, metrics=None, log=None, startup=None, mem=None, nfcs=(), idle_gc=None):
+        self._db = db
+        self._idle_gc = idle_gc
+        # the doors' readers, for their error counters in the stats event
+        self._nfcs = nfcs
+        self._metrics = metrics
+        self._mem = mem
+        self._log = log
+        self._startup = startup
+        self._metrics_due = False
         self._connected = False
-        self._wlan = network.WLAN(network.STA_IF)
+        self._wlan = None
+        self._mqtt = None
 
-        self._events = []
-        # keepalive is needed due to: https://github.com/eclipse/mosquitto/issues/2462
-        self._mqtt = MQTTClient("lock", "10.11.1.1", keepalive=5)
-        self._mqtt.set_callback(self._mqtt_cb)
+        # events can be queued before the network is up
+        self._events = EventQueue(EVENT_QUEUE_SIZE, EVENT_QUEUE_POLICY)
+        self._wake = asyncio.Event()
+        self._syncing = False
+        self._backoff = MQTT_BACKOFF_MIN
+        # the broker drops a client when another one connects with its id
+        self.client_id = "lock-" + machine.unique_id().hex()
 
     async def loop(self):
-        self.start()
+        # The doors come first: Wi-Fi and MQTT are imported and started only
+        # once the readers are configured (or NET_START_DELAY passed).
+        if self._startup:
+            try:
+                await asyncio.wait_for(self._startup.ready.wait(), NET_START_DELAY)
+            except asyncio.TimeoutError:
+                pass
+        from mqtt_async import MQTTClient
+        # keepalive is needed due to: https://github.com/eclipse/mosquitto/issues/2462
+        self._mqtt = MQTTClient(self.client_id, MQTT_BROKER, keepalive=5)
+        self._mqtt.set_callback(self._mqtt_cb)
+        try:
+            self.start()
+        except OSError as e:
+            # the doors keep working without the network
+            print(f"network not started: {e}")
+            return
+        asyncio.create_task(self._run_mqtt())
+        if self._metrics:
+            asyncio.create_task(self._metrics_timer())
         while True:
             self.update()
             await asyncio.sleep(0.5)
 
     def _mqtt_cb(self, topic, msg):
         if topic == b'locks/internal/command':
-            if msg == b'sync':
-                try:
-                    print("starting sync")
-                    # TODO: add auth support to http server
-                    url = "http://10.11.1.1:8000/hashes/internal"
-                    print(f"fetching: {url}")
-                    rsp = requests.get(url)
-                    print(f"sync code: {rsp.status_code}")
-                    with open('hashes_new', 'wb') as f:
-                        if 200 <= rsp.status_code < 300:
-                            while True:
-                                chunk = rsp.raw.read(512)
-                                if not chunk:
-                                    break
-                                f.write(chunk)
-                    os.rename('hashes_new', 'hashes')
-                    print("sync finished")
-                    self.send_event("sync", 'success'.encode())
-                except Exception as e:
-                    print(f"sync error: {e}")
-                    self.send_event("sync", 'fail'.encode())
+            if msg == b'sync' or msg.startswith(b'sync '):
+                if not self._syncing:
+                    try:
+                        spread = int(msg[5:]) if len(msg) > 4 else SYNC_SPREAD
+                    except ValueError:
+                        spread = SYNC_SPREAD
+                    self._syncing = True
+                    asyncio.create_task(self._sync(spread))
+            elif msg == b'stats':
+                stats = self._db.stats()
+                stats['events'] = self._events.stats()
+                if self._log:
+                    stats['log'] = self._log.stats()
+                if self._mem:
+                    stats['mem'] = self._mem.stats()
+                if self._nfcs:
+                    stats['pn532'] = [nfc.errors for nfc in self._nfcs]
+                self.send_event("stats", json.dumps(stats).encode())
             else:
                 print(f"uncrecognised command: {msg}")
 
+    async def _sync(self, spread=0):
+        import dbsync
+        if spread:
+            await asyncio.sleep(spread * random.getrandbits(16) / 65536)
+        # lookups keep using the old generation until the new one is verified
+        mem = self._mem
+        if mem:
+            m = mem.start()
+        try:
+            print(f"starting sync: {SYNC_URL}")
+            version, mode = await dbsync.sync(SYNC_URL, self._db)
+            print(f"sync finished, version {version} ({mode})")
+            result = {'result': 'success', 'version': version, 'mode': mode}
+        except Exception as e:
+            print(f"sync error: {e}")
+            result = {'result': 'fail', 'version': hashdb.db_version(self._db.path)}
+        finally:
+            self._syncing = False
+        if mem:
+            mem.stop('net.sync', m)
+        if self._idle_gc:
+            # a sync leaves a lot of garbage, clean up before the next tap
+            self._idle_gc.collect()
+        self.send_event("sync", json.dumps(result).encode())
 
     def send_event(self, name, payload):
-        # TODO: limit number of events in queue
-        self._events.append((name, payload))
+        self._events.put(name, payload)
+        self._wake.set()
 
+    async def _metrics_timer(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            self._metrics_due = True
+            self._wake.set()
+
+    async def _publish_events(self, mqtt):
+        # A single event goes to its own topic, a backlog (e.g. after a
+        # reconnect) is sent as batches to locks/internal/events/batch.
+        events = self._events
+        while len(events):
+            if len(events) == 1:
+                name, payload = events.peek()
+                topic = f"locks/internal/events/{name}"
+                n = 1
+            else:
+                n, payload = events.encode_batch(EVENT_BATCH_BYTES)
+                topic = "locks/internal/events/batch"
+            print(f"sending {n} event(s)")
+            # events queued meanwhile must not drop or overwrite these
+            events.hold(n)
+            try:
+                await mqtt.publish(topic, payload)
+            finally:
+                events.release()
+            events.discard(n)
+
+    async def _upload_log(self, mqtt):
+        # Access records the broker has not seen yet, e.g. all those from
+        # while we were offline. The cursor is saved after every chunk, so
+        # an upload that is cut short continues there after the reconnect.
+        log = self._log
+        while True:
+            seq, records = log.read(LOG_UPLOAD_RECORDS)
+            if not records:
+                return
+            n = len(records) // accesslog.RECORD_SIZE
+            print(f"uploading {n} access record(s) from {seq}")
+            await mqtt.publish("locks/internal/log", records)
+            log.ack(seq + n)
+
+    def _set_clock(self):
+        # Blocks for up to ntptime.timeout (1 s), once per connection until
+        # it worked.
+        import ntptime
+        ntptime.host = NTP_HOST
+        try:
+            ntptime.settime()
+        except Exception as e:
+            print(f"ntp error: {e}")
+            return
+        print(f"clock set from {NTP_HOST}")
+        self._log.time_synced = True
+
+    async def _read_mqtt(self, mqtt):
+        while True:
+            await mqtt.wait_msg()
 
-    def _run_mqtt(self):
+    async def _mqtt_session(self):
+        from mqtt_async import MQTTError
         mqtt = self._mqtt
+        await mqtt.connect()
+        print("mqtt connected")
+        if self._startup and 'mqtt' not in self._startup.phases:
+            self._startup.mark('mqtt')
+            self.send_event("boot", self._startup.encode())
+        self._backoff = MQTT_BACKOFF_MIN
+        await mqtt.publish("locks/internal/mac", self._wlan.config('mac').hex())
+        await mqtt.subscribe("locks/internal/command")
+        if self._log and not self._log.time_synced:
+            self._set_clock()
+
+        # Incoming commands are handled by the reader task as soon as they
+        # arrive, this task publishes events and keeps the connection alive.
+        reader = asyncio.create_task(self._read_mqtt(mqtt))
+        keepalive_ms = mqtt.keepalive * 1000
+        try:
+            while True:
+                metrics = self._metrics
+                if metrics:
+                    t = metrics.start()
+                await self._publish_events(mqtt)
+                if self._log:
+                    await self._upload_log(mqtt)
+                if metrics:
+                    metrics.stop('mqtt.publish', t)
+                    if self._metrics_due:
+                        # histograms keep filling up while we are offline
+                        await mqtt.publish("locks/internal/metrics", metrics.encode())
+                        self._metrics_due = False
+
+                if reader.done():
+                    raise MQTTError('connection lost')
+                # Publishing is no sign the broker is still there, only its
+                # answers are: ping whenever it was quiet for half an
+                # interval, and give up when a ping stays unanswered.
+                now = utime.ticks_ms()
+                if mqtt.ping_sent is not None:
+                    if utime.ticks_diff(now, mqtt.ping_sent) > keepalive_ms:
+                        raise MQTTError('keepalive timeout')
+                elif (utime.ticks_diff(now, mqtt.last_rx) >= keepalive_ms // 2 or
+                      utime.ticks_diff(now, mqtt.last_tx) >= keepalive_ms // 2):
+                    await mqtt.ping()
+
+                try:
+                    await asyncio.wait_for(self._wake.wait(), mqtt.keepalive / 2)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+        finally:
+            reader.cancel()
+
+    async def _run_mqtt(self):
         while True:
             try:
-                while True:
-                    mqtt.connect()
-                    mqtt.publish("locks/internal/mac", self._wlan.config('mac').hex())
-                    mqtt.subscribe("locks/internal/command")
-
-                    i = 0
-                    while True:
-                        try:
-                            while True:
-                                name, payload = self._events.pop()
-                                print("sending event")
-                                mqtt.sock.setblocking(True)
-                                mqtt.publish(f"locks/internal/events/{name}", payload)
-                        except IndexError:
-                            pass
-
-                        if i == 10:
-                            i = 0
-                            mqtt.ping()
-                        else:
-                            i += 1
-
-                        mqtt.check_msg()
-                        utime.sleep(0.25)
-
+                await self._mqtt_session()
             except Exception as e:
                 print(f"mqtt exception: {e}")
-                utime.sleep(6)
+            await self._mqtt.close()
+
+            print(f"mqtt reconnect in {self._backoff}s")
+            await asyncio.sleep(self._backoff)
+            self._backoff = min(self._backoff * 2, MQTT_BACKOFF_MAX)
 
     def start(self):
+        import network
+        self._wlan = network.WLAN(network.STA_IF)
         self._wlan.active(True)
         # for net in self._wlan.scan():
         #     print(f'scan: {net}')
         print("mac:", self._wlan.config('mac').hex())
 
-        _thread.start_new_thread(self._run_mqtt, ())
-
         with open('wifi', 'r') as f:
             ssid = f.readline().strip()
             key = f.readline().strip()
@@ -152,15 +418,55 @@ class Net:
             if not self._connected:
                 print('network config:', self._wlan.ifconfig())
                 self._connected = True
+                if self._startup and 'wifi' not in self._startup.phases:
+                    self._startup.mark('wifi')
         else:
             if self._connected:
                 print('disconnected')
                 self._connected = False
 
 
+class Startup:
+    """
+    When each phase of a cold start finished, in ms after main.py started
+    importing. `boot` is the time before that (firmware and boot.py). The
+    phases are printed as they finish and sent as the `boot` event once MQTT
+    is connected.
+    """
+    def __init__(self, start=_START):
+        self._start = start
+        self.phases = {'boot': start}
+        self.ready = asyncio.Event()
+
+    def mark(self, phase):
+        ms = utime.ticks_diff(utime.ticks_ms(), self._start)
+        self.phases[phase] = ms
+        print(f"startup: {phase} after {ms}ms")
+
+    async def wait_readers(self, nfcs):
+        for nfc in nfcs:
+            await nfc.ready.wait()
+        self.mark('readers')
+        self.ready.set()
+
+    def encode(self):
+        return json.dumps(self.phases).encode()
+
+
 class Door:
-    def __init__(self, pin):
+    def __init__(self, pin, name=None, number=0):
         self._pin = pin
+        self.name = name
+        # index in DOORS, for the access log
+        self.number = number
+        self.label = f"[{name}] " if name else ""
+        # open_for() unlocks until _until (ticks_ms), loop() locks again
+        self.is_open = False
+        self._until = 0
+        self._opened = asyncio.Event()
+
+    def event(self, name):
+        return name if self.name is None else f"{name}/{self.name}"
 
     def unlock(self):
         if self._pin is not None:
@@ -170,149 +476,421 @@ class Door:
         if self._pin is not None:
             self._pin.value(0)
 
-def generate_hash(card_uid, pin):
-    card_uid = bytes(reversed(card_uid[:4])).hex()
-    s = "{:08x}:{}".format(int(pin), card_uid)
-    hash=hashlib.sha256(s.encode('ascii')).digest().hex()
-    return hash
+    def open_for(self, seconds):
+        """Unlock for `seconds`, an open door stays open for at least that long."""
+        until = utime.ticks_add(utime.ticks_ms(), int(seconds * 1000))
+        if not self.is_open:
+            self._until = until
+            self.is_open = True
+            self.unlock()
+            self._opened.set()
+        elif utime.ticks_diff(until, self._until) > 0:
+            self._until = until
+
+    async def loop(self):
+        # The unlock timer, on its own task so handle_auth can serve the
+        # next user while the door is open
+        while True:
+            await self._opened.wait()
+            self._opened.clear()
+            while True:
+                remaining = utime.ticks_diff(self._until, utime.ticks_ms())
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining / 1000)
+            self.is_open = False
+            self.lock()
 
+def ensure_hashdb():
+    # existing deployments only have the hex-lines file, convert it once
+    if not hashdb.is_db(HASHDB_FILE):
+        try:
+            n = hashdb.convert_hex_lines(HASHES_FILE, HASHDB_FILE)
+            print(f"converted {n} hashes to {HASHDB_FILE}")
+        except OSError as e:
+            print(f"no hash database: {e}")
 
-async def handle_auth(nfc, keypad, door, net):
+
+async def _cancel_on_removal(nfc, keypad):
+    await nfc.wait_removed()
+    keypad.cancel()
+
+
+# handle_auth states
+_AUTH_IDLE = 0      # keypad reset, waiting for a tap
+_AUTH_RESULT = 1    # keypad shows the last result until the next tap or result_ms
+
+
+async def handle_auth(nfc, keypad, door, net, db, metrics=None, limiter=None, log=None, mem=None):
+    # One stage of a pipeline: Nfc.loop queues taps while a PIN is typed,
+    # this task takes one tap at a time through PIN entry and lookup, and
+    # door.loop() runs the unlock timer. A grant extends the door's unlock
+    # time and the next queued tap is served right away, the result on the
+    # keypad is cut short by it.
+    state = _AUTH_IDLE
+    result_ms = 0
+    m = None
     while True:
-        card_info = await nfc.wait_uid()
+        # the run for the last tap ended wherever it continued
+        if m is not None:
+            mem.stop('auth', m)
+            m = None
+        card_info = await nfc.wait_uid(None if state == _AUTH_IDLE else result_ms)
+        if card_info is None:
+            # nobody waiting, the result was shown long enough
+            keypad.write(keypad.CMD_RESET)
+            state = _AUTH_IDLE
+            continue
+        if mem:
+            m = mem.start()
+        t_card = utime.ticks_us()
         if isinstance(card_info, tuple):
             card_type, card_uid = card_info
         else:
-            card_type, card_uid = "mifare", card_info
+            card_type, card_uid = CARD_MIFARE, card_info
 
-        if card_type == "mifare":
+        if card_type == CARD_MIFARE:
             uid_hex = ''.join('{:02x}'.format(x) for x in card_uid)
-            print("Card UUID (Mifare): " + uid_hex)
-            used_uid = card_uid
-        elif card_type == "android":
-            print("Card UUID (Android app): " + str(card_uid))
-            # Convert to bytes for hashing if needed
-            try:
-                used_uid = bytes.fromhex(card_uid)
-            except Exception:
-                used_uid = card_uid.encode() if isinstance(card_uid, str) else card_uid
+            print(f"{door.label}Card UUID (Mifare): " + uid_hex)
+        elif card_type == CARD_ANDROID:
+            print(f"{door.label}Card UUID (Android app): " + str(card_uid))
         else:
             print("Unknown card type")
             continue
+        # Convert to the bytes that are hashed, see credentials.py
+        used_uid = uid_bytes(card_type, card_uid)
+
+        # A card that keeps coming back is turned away before anything else
+        if limiter:
+            denied = limiter.check(used_uid)
+            if denied:
+                print(f"{door.label}Too many attempts, ignoring card")
+                if denied == 1:
+                    # once per burst
+                    info = {'type': card_type, 'uid': bytes(used_uid).hex()}
+                    net.send_event(door.event("throttled"), json.dumps(info).encode())
+                    if log:
+                        log.add(accesslog.THROTTLED, used_uid, card_type, door.number)
+                keypad.write(keypad.CMD_DENIED)
+                state, result_ms = _AUTH_RESULT, int(DENY_TIME * 1000)
+                continue
+
+        if state == _AUTH_RESULT:
+            # this tap cut the last result short, clear it as the idle path
+            # does before the prompt
+            keypad.write(keypad.CMD_RESET)
+            state = _AUTH_IDLE
 
-        pin = await keypad.get_pin()
+        # Spans are measured always, they go to the access log as well
+        t = utime.ticks_us()
+        watch = asyncio.create_task(_cancel_on_removal(nfc, keypad)) if PIN_NEEDS_CARD else None
+        try:
+            pin = await keypad.get_pin()
+        finally:
+            if watch:
+                watch.cancel()
+        pin_us = utime.ticks_diff(utime.ticks_us(), t)
+        if metrics:
+            metrics.add('auth.pin', pin_us)
         keypad.write(keypad.CMD_RESET)
 
-        if len(pin) < 4:
-            print("Pin timeout")
+        if len(pin) < keypad.PIN_LENGTH:
+            removed = PIN_NEEDS_CARD and not nfc.present
+            print("Card removed" if removed else "Pin timeout")
             keypad.write(keypad.CMD_DENIED)
-            await asyncio.sleep(0.5)
-            keypad.write(keypad.CMD_RESET)
+            if log:
+                log.add(accesslog.REMOVED if removed else accesslog.TIMEOUT, used_uid, card_type, door.number,
+                        pin_us // 1000)
+            state, result_ms = _AUTH_RESULT, int(DENY_TIME * 1000)
             continue
 
-        hash = generate_hash(used_uid, pin)
+        t = utime.ticks_us()
+        digest = generate_digest(used_uid, pin)
+        hash_us = utime.ticks_diff(utime.ticks_us(), t)
+        if metrics:
+            metrics.add('auth.hash', hash_us)
+        hash = digest.hex()
         print(f'Card hash: {hash}')
 
-        hash_found = False
-        with open("hashes") as f:
-            for user in f:
-                if(user.strip() == hash):
-                    hash_found = True
-                    break
-
-        net.send_event("hash", hash.encode())
+        t = utime.ticks_us()
+        hash_found = digest in db
+        lookup_us = utime.ticks_diff(utime.ticks_us(), t)
+        if metrics:
+            metrics.add('auth.lookup', lookup_us)
 
-        try:
-            if hash_found:
-                print('Known hash, opening door')
-                keypad.write(keypad.CMD_GRANTED)
-                door.unlock()
-            else:
-                print('Unknown hash, ignoring')
-                keypad.write(keypad.CMD_DENIED)
+        net.send_event(door.event("hash"), hash.encode())
 
-            await asyncio.sleep(2)
+        if hash_found:
+            print('Known hash, opening door')
+            keypad.write(keypad.CMD_GRANTED)
+            door.open_for(UNLOCK_TIME)
+        else:
+            print('Unknown hash, ignoring')
+            keypad.write(keypad.CMD_DENIED)
+        # card handed over until the door reacted, PIN entry included
+        total_us = utime.ticks_diff(utime.ticks_us(), t_card)
+        if metrics:
+            metrics.add('auth.total', total_us)
+        if log:
+            log.add(accesslog.GRANTED if hash_found else accesslog.DENIED, digest, card_type, door.number,
+                    pin_us // 1000, hash_us, lookup_us, total_us // 1000)
 
-        finally:
-            door.lock()
-            keypad.write(keypad.CMD_RESET)
+        # a denial only holds up this door briefly, the limiter deals
+        # with repeated attempts
+        state, result_ms = _AUTH_RESULT, int((UNLOCK_TIME if hash_found else DENY_TIME) * 1000)
 
 
 class Nfc:
-    def __init__(self):
-        self._uids = []
+    # Polling engines:
+    #   MODE_POLL      the host wakes the reader every 250 ms and asks for a card
+    #   MODE_AUTOPOLL  the reader polls by itself (InAutoPoll) and the host
+    #                  sleeps until it reports a card
+    MODE_POLL = 'poll'
+    MODE_AUTOPOLL = 'autopoll'
+
+    # A card is reported once per tap. While it stays on the reader it is kept
+    # activated and checked every PRESENCE_INTERVAL seconds (a Diagnose
+    # presence check for phones, listing it again for Mifare cards) instead
+    # of being found again by the next poll:
+    #   absent -> present  card reported to wait_uid()
+    #   present -> absent  card taken away, wait_removed() returns
+    # Standard AID for the Android app (must match the app's AID)
+    ANDROID_AID = "A0000001020304"  # This is the default in the Android app
+
+    def __init__(self, mode=MODE_POLL, metrics=None, reader=(2, 22, 19), name=None, baudrate=115200, mem=None,
+                 idle_gc=None):
+        # waiting taps, oldest first: (ticks_ms, (card type, uid))
+        self._taps = []
         self._flag = asyncio.Event()
+        self.mode = mode
+        self.label = f"[{name}] " if name else ""
+        self._metrics = metrics
+        self._mem = mem
+        self._idle_gc = idle_gc
+        self._reader = reader
+        self._baudrate = baudrate
+        # set once the reader is configured and polling
+        self.ready = asyncio.Event()
+        # a card is on the reader, set when it was taken away
+        self.present = False
+        self._removed = asyncio.Event()
+        self.taps = 0
+        # the reader's PN532Uart.errors, once it was created
+        self.errors = None
+
+    async def wait_uid(self, timeout_ms=None):
+        """
+        Return the oldest waiting tap as (card type, uid), or None if there
+        was none within timeout_ms (None waits forever).
+        """
+        taps = self._taps
+        if timeout_ms is not None:
+            deadline = utime.ticks_add(utime.ticks_ms(), timeout_ms)
+        while True:
+            while taps:
+                t, card = taps.pop(0)
+                # whoever tapped that long ago has given up
+                if utime.ticks_diff(utime.ticks_ms(), t) <= TAP_MAX_AGE_MS:
+                    return card
 
-    async def wait_uid(self):
-        # discard queued uids
-        for _ in range(len(self._uids)):
-            self._uids.pop()
-
-        while not self._uids:
-            await self._flag.wait()
             self._flag.clear()
-
-        uid = None
-        while self._uids:
-            uid = self._uids.pop()
-        return uid
-
-    async def loop(self):
-        rf = PN532Uart(2, rx=19, tx=22)
-
+            if timeout_ms is None:
+                await self._flag.wait()
+                continue
+            remaining = utime.ticks_diff(deadline, utime.ticks_ms())
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self._flag.wait(), remaining / 1000)
+            except asyncio.TimeoutError:
+                return None
+
+    def _queue(self, card):
+        taps = self._taps
+        # a card tapped again while waiting keeps one place in the queue
+        for i in range(len(taps)):
+            if taps[i][1] == card:
+                taps.pop(i)
+                break
+        if len(taps) >= TAP_QUEUE:
+            taps.pop(0)
+        taps.append((utime.ticks_ms(), card))
+        self.taps += 1
+        self._flag.set()
+
+    async def wait_removed(self):
+        """Wait until no card is on the reader."""
+        while self.present:
+            await self._removed.wait()
+
+    async def _hold(self, rf, target):
+        # Keep the target activated until it is taken away. A reader error
+        # ends the session as well, the card is then found again by the poll.
+        self.present = True
+        self._removed.clear()
         try:
-            rf.SAM_configuration()
-            ic, ver, rev, support = rf.get_firmware_version()
-            print(f'Found PN532 with firmware version: {ver}.{rev}')
-        except Exception as e:
-            print('No NFC reader (PN532) detected')
-            raise
+            while True:
+                await asyncio.sleep(PRESENCE_INTERVAL)
+                if not await rf.check_target(target):
+                    break
+        finally:
+            self.present = False
+            self._removed.set()
+
+    async def _handle_target(self, rf, target):
+        # Try SELECT AID APDU on the activated target if it speaks ISO14443-4
+        # If the app responds (returns a UID), use that UID for authentication.
+        # If not, use the hardware UID from the card.
+        metrics = self._metrics
+        hce_uid = None
+        if target.iso14443_4:
+            if metrics:
+                t = metrics.start()
+            hce_uid = await rf.select_aid(target, self.ANDROID_AID)
+            if metrics:
+                metrics.stop('nfc.select', t)
+        if hce_uid:
+            # Android app responded: use the UID returned by the app
+            self._queue((CARD_ANDROID, hce_uid))
+        else:
+            # No app response: use the hardware UID from the card
+            self._queue((CARD_MIFARE, target.uid))
+
+    async def _poll(self, rf):
+        metrics = self._metrics
+        mem = self._mem
+        idle_gc = self._idle_gc
+        while True:
+            if mem:
+                m = mem.start()
+            try:
+                # Wait for any card (phone or physical), it stays activated
+                if metrics:
+                    t = metrics.start()
+                target = await rf.read_passive_target()
+                if metrics:
+                    metrics.stop('nfc.poll', t)
+                if target is not None:
+                    await self._handle_target(rf, target)
+                    await self._hold(rf, target)
+            except PN532Error as e:
+                print(f'{self.label}PN532:', e)
 
-        # Standard AID for the Android app (must match the app's AID)
-        ANDROID_AID = "A0000001020304"  # This is the default in the Android app
+            try:
+                await rf.power_down()
+            except PN532Error as e:
+                print(f'{self.label}PN532:', e)
+            if mem:
+                mem.stop('nfc.loop', m)
+            if idle_gc:
+                # nothing to do for 250 ms, a good time to collect
+                idle_gc.collect_idle()
+            await asyncio.sleep(0.25)
 
+    async def _autopoll(self, rf):
+        mem = self._mem
+        idle_gc = self._idle_gc
         while True:
+            if mem:
+                m = mem.start()
             try:
-                # 1. Wait for any card (phone or physical)
-                uid = rf.read_passive_target()
-                if uid is not None:
-                    # 2. Always try SELECT AID APDU after card detection
-                    #    If the app responds (returns a UID), use that UID for authentication.
-                    #    If not, use the hardware UID from the card.
-                    hce_uid = rf.read_hce_uid(aid_hex=ANDROID_AID)
-                    if hce_uid:
-                        # Android app responded: use the UID returned by the app
-                        self._uids.append(("android", hce_uid))
-                    else:
-                        # No app response: use the hardware UID from the card
-                        self._uids.append(("mifare", uid))
-                    self._flag.set()
+                # The reader polls every 150 ms, we only hear from it when
+                # there is a card (or once a minute when there is none)
+                target = await rf.auto_poll(period=1, timeout_ms=60000)
+                if target is None:
+                    if mem:
+                        mem.stop('nfc.loop', m)
+                    if idle_gc:
+                        idle_gc.collect_idle()
+                    continue
+                await self._handle_target(rf, target)
+                await self._hold(rf, target)
+                await rf.release_targets()
             except PN532Error as e:
-                print('PN532:', e)
+                print(f'{self.label}PN532:', e)
 
-            rf.power_down()
+            if mem:
+                mem.stop('nfc.loop', m)
+            if idle_gc:
+                idle_gc.collect_idle()
+            # let the card be taken away before polling again
             await asyncio.sleep(0.25)
 
+    async def loop(self):
+        uart, tx, rx = self._reader
+        rf = AsyncPN532Uart(uart, rx=rx, tx=tx)
+        rf.metrics = self._metrics
+        rf.mem = self._mem
+        self.errors = rf.errors
 
-async def main():
-    print("Lock app wil start in 2s")
-    await asyncio.sleep(2)
+        # A missing reader only takes its own door down, keep trying
+        while True:
+            try:
+                await rf.SAM_configuration()
+                ic, ver, rev, support = await rf.get_firmware_version()
+                print(f'{self.label}Found PN532 with firmware version: {ver}.{rev}')
+                if self._baudrate != rf.baudrate and not await rf.set_baudrate(self._baudrate):
+                    print(f'{self.label}PN532 does not answer at {self._baudrate} baud, staying at {rf.baudrate}')
+                self.ready.set()
+                break
+            except Exception as e:
+                print(f'{self.label}No NFC reader (PN532) detected: {e}')
+                await asyncio.sleep(READER_RETRY)
+
+        if self.mode == self.MODE_AUTOPOLL:
+            await self._autopoll(rf)
+        else:
+            await self._poll(rf)
 
-    keypad = Keypad(machine.UART(1, tx=16, rx=17, baudrate=9600))
-    keypad.write(keypad.CMD_RESET)
 
-    nfc = Nfc()
+async def main():
+    startup = Startup()
+    startup.mark('imports')
+
+    # tracing costs nothing unless DEBUG is on
+    metrics = Metrics() if DEBUG else None
+    # collections in the idle gaps of the poll loop, heap accounting (which
+    # walks the heap) only with MEM_STATS on
+    mem = MemStats(GC_IDLE_INTERVAL_MS) if MEM_STATS else None
+    idle_gc = mem or IdleGC(GC_IDLE_INTERVAL_MS)
+
+    ensure_hashdb()
+    db = HashStore(HASHDB_FILE, mem_budget=HASHDB_CACHE_BYTES)
+    # build the cache now, not on the first tap
+    db.load()
+    # shared by all doors
+    decisions = DecisionCache(db, AUTH_CACHE_SIZE, AUTH_CACHE_TTL_MS)
+    limiter = RateLimiter(AUTH_BURST, AUTH_REFILL_MS)
+    startup.mark('hashdb')
+
+    log = AccessLog(ACCESS_LOG, LOG_SEGMENTS, LOG_SEGMENT_RECORDS, flush_interval=LOG_FLUSH_INTERVAL)
+    print(f"access log at record {log.head}, uploaded up to {log.cursor}")
+    nfcs = []
+    net = Net(db, metrics, log, startup, mem, nfcs, idle_gc)
+
+    # Every reader waits for its PN532 on its own task, so a slow or dead
+    # reader only delays its own door. Doors grant access from the local
+    # database while Net is still bringing up the network.
+    tasks = [log.loop()]
+    for number, cfg in enumerate(DOORS):
+        uart, tx, rx = cfg['keypad']
+        keypad = Keypad(machine.UART(uart, tx=tx, rx=rx, baudrate=9600), PIN_TYPEAHEAD_MS)
+        keypad.write(keypad.CMD_RESET)
+        tasks.append(keypad.loop())
 
-    door = Door(machine.Pin(2, machine.Pin.OUT))
-    door.lock()
+        door = Door(machine.Pin(cfg['lock'], machine.Pin.OUT), cfg['name'], number)
+        door.lock()
+        tasks.append(door.loop())
 
-    net = Net()
+        nfc = Nfc(NFC_MODE, metrics, cfg['reader'], cfg['name'], READER_BAUDRATE, mem, idle_gc)
+        nfcs.append(nfc)
+        tasks.append(handle_auth(nfc, keypad, door, net, decisions, metrics, limiter, log, mem))
+        tasks.append(nfc.loop())
+    startup.mark('doors')
 
-    await asyncio.gather(
-        handle_auth(nfc, keypad, door, net),
-        nfc.loop(),
-        net.loop()
-    )
+    tasks.append(startup.wait_readers(nfcs))
+    tasks.append(net.loop())
+    await asyncio.gather(*tasks)
 
 
 if __name__ == '__main__':
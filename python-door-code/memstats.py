@@ -0,0 +1,105 @@
+# Heap and GC instrumentation for the lock.
+#
+# gc.collect pauses and heap fragmentation are what make unlock latency
+# unpredictable. IdleGC schedules collections: collect_idle() is called in
+# the gaps of the poll loop and collects once interval_ms passed since the
+# last collection, so the heap is cleaned up between taps instead of by an
+# automatic collection during one. It never reads the heap counters, which
+# walk the whole heap on MicroPython, so it is cheap enough to always run.
+#
+# MemStats (DEBUG only) collects on the same schedule and also records, per
+# named path, how many bytes a span allocated (gc.mem_alloc before and
+# after) and how often the heap shrank during one, i.e. the GC ran in the
+# middle of it. Every collection it runs is counted and timed, and the
+# lowest gc.mem_free seen is kept. Callers hold a MemStats instance or None,
+# like Metrics. Under CPython (the emulator) gc has no mem_alloc/mem_free and
+# the heap numbers stay 0.
+#
+# stats() returns {"free": <bytes>, "alloc": <bytes>, "min_free": <bytes>,
+# "gc": [count, sum us, max us], "p": {<path>: [count, bytes, max bytes,
+# collections]}} for the stats event.
+
+import gc
+import utime
+from metrics import Histogram
+
+try:
+    _mem_alloc = gc.mem_alloc
+    _mem_free = gc.mem_free
+except AttributeError:
+    def _mem_alloc():
+        return 0
+
+    def _mem_free():
+        return 0
+
+
+class Path:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.collections = 0
+
+
+class IdleGC:
+    def __init__(self, interval_ms=5000):
+        self.interval_ms = interval_ms
+        self._last = utime.ticks_ms()
+
+    def collect(self):
+        gc.collect()
+        self._last = utime.ticks_ms()
+
+    def collect_idle(self):
+        """Collect if interval_ms passed since the last collection."""
+        if utime.ticks_diff(utime.ticks_ms(), self._last) >= self.interval_ms:
+            self.collect()
+
+
+class MemStats(IdleGC):
+    def __init__(self, interval_ms=5000):
+        super().__init__(interval_ms)
+        self._paths = {}
+        self.collections = 0
+        self.collect_us = Histogram()
+        self.min_free = _mem_free()
+
+    def start(self):
+        return _mem_alloc()
+
+    def stop(self, name, start):
+        """Record the bytes allocated since `start` (a start() value)."""
+        alloc = _mem_alloc()
+        p = self._paths.get(name)
+        if p is None:
+            p = self._paths[name] = Path()
+        p.count += 1
+        if alloc < start:
+            # collected in between, what the span allocated is unknown
+            p.collections += 1
+        else:
+            n = alloc - start
+            p.total += n
+            if n > p.max:
+                p.max = n
+        free = _mem_free()
+        if free < self.min_free:
+            self.min_free = free
+
+    def collect(self):
+        """Run a collection and time it."""
+        t = utime.ticks_us()
+        super().collect()
+        self.collect_us.add(utime.ticks_diff(utime.ticks_us(), t))
+        self.collections += 1
+
+    def stats(self):
+        h = self.collect_us
+        return {
+            'free': _mem_free(),
+            'alloc': _mem_alloc(),
+            'min_free': self.min_free,
+            'gc': [h.count, h.total, h.max],
+            'p': {name: [p.count, p.total, p.max, p.collections] for name, p in self._paths.items()},
+        }
@@ -0,0 +1,100 @@
+# Latency tracing for the lock.
+#
+# Spans are measured with utime.ticks_us and folded into fixed size log2
+# histograms, so tracing allocates nothing per span. Bucket 0 counts spans
+# under 64 us, bucket i spans from 32 << i up to 64 << i us, the last bucket
+# everything from about one second up.
+#
+# Callers hold a Metrics instance or None; with tracing off (DEBUG = False)
+# every span is skipped behind a single `if metrics:` check.
+#
+# Metrics.encode() returns the histograms gathered since the last call as
+# JSON: {"t": <interval ms>, "h": {<name>: [count, sum us, max us, bucket
+# counts...]}}, trailing empty buckets left out.
+
+from array import array
+import json
+import utime
+
+BUCKETS = 16
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = array('I', [0] * BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, us):
+        i = 0
+        d = us >> 6
+        while d and i < BUCKETS - 1:
+            d >>= 1
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def reset(self):
+        for i in range(BUCKETS):
+            self.buckets[i] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def encode(self):
+        n = BUCKETS
+        while n and not self.buckets[n - 1]:
+            n -= 1
+        return [self.count, self.total, self.max] + list(self.buckets[:n])
+
+
+class Metrics:
+    """
+    Named histograms, plus one per PN532 command code. Names are fixed
+    strings at the call sites, a histogram is created the first time a name
+    is recorded.
+    """
+    def __init__(self):
+        self._hists = {}
+        self._commands = {}
+        self._since = utime.ticks_ms()
+
+    def start(self):
+        return utime.ticks_us()
+
+    def stop(self, name, start):
+        """Record the span from `start` (a start() value) until now."""
+        self.add(name, utime.ticks_diff(utime.ticks_us(), start))
+
+    def add(self, name, us):
+        """Record a span measured by the caller."""
+        h = self._hists.get(name)
+        if h is None:
+            h = self._hists[name] = Histogram()
+        h.add(us)
+
+    def stop_command(self, command, start):
+        h = self._commands.get(command)
+        if h is None:
+            h = self._commands[command] = Histogram()
+        h.add(utime.ticks_diff(utime.ticks_us(), start))
+
+    def encode(self):
+        """Encode and reset the histograms that saw spans since the last call."""
+        now = utime.ticks_ms()
+        hists = {}
+        for name, h in self._hists.items():
+            if h.count:
+                hists[name] = h.encode()
+                h.reset()
+        for command, h in self._commands.items():
+            if h.count:
+                hists['pn532.{:02x}'.format(command)] = h.encode()
+                h.reset()
+        msg = json.dumps({'t': utime.ticks_diff(now, self._since), 'h': hists})
+        self._since = now
+        return msg.encode()
@@ -0,0 +1,141 @@
+# Minimal asyncio MQTT 3.1.1 client (QoS 0 only).
+#
+# Built on asyncio.open_connection, so waiting for the broker never blocks
+# the event loop. Keepalive bookkeeping is left to the caller: last_tx and
+# last_rx hold the ticks_ms of the last packet sent and received, ping_sent
+# that of the PINGREQ still waiting for its PINGRESP (None: none is).
+
+import asyncio
+import utime
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+class MQTTError(Exception):
+    pass
+
+
+def _str(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return bytes((len(s) >> 8, len(s) & 0xFF)) + s
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=1883, keepalive=60):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.cb = None
+        self.last_tx = 0
+        self.last_rx = 0
+        self.ping_sent = None
+        self._reader = None
+        self._writer = None
+        self._pid = 0
+
+    def set_callback(self, f):
+        self.cb = f
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def _send(self, packet_type, body):
+        n = len(body)
+        header = bytearray((packet_type,))
+        while True:
+            b = n & 0x7F
+            n >>= 7
+            header.append(b | 0x80 if n else b)
+            if not n:
+                break
+        w = self._writer
+        if w is None:
+            raise MQTTError('not connected')
+        w.write(header)
+        w.write(body)
+        await w.drain()
+        self.last_tx = utime.ticks_ms()
+
+    async def _recv(self):
+        r = self._reader
+        packet_type = (await r.readexactly(1))[0]
+        n = 0
+        shift = 0
+        while True:
+            b = (await r.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        body = await r.readexactly(n) if n else b''
+        self.last_rx = utime.ticks_ms()
+        return packet_type, body
+
+    async def connect(self, timeout=5):
+        self.ping_sent = None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port), timeout)
+        # protocol name, level 4, clean session, keepalive, client id
+        body = _str('MQTT') + bytes((4, 0x02, self.keepalive >> 8, self.keepalive & 0xFF)) + _str(self.client_id)
+        await self._send(CONNECT, body)
+        packet_type, body = await asyncio.wait_for(self._recv(), timeout)
+        if packet_type != CONNACK or len(body) != 2 or body[1] != 0:
+            await self.close()
+            raise MQTTError('connection refused')
+
+    async def publish(self, topic, msg):
+        if isinstance(msg, str):
+            msg = msg.encode()
+        await self._send(PUBLISH, _str(topic) + msg)
+
+    async def subscribe(self, topic):
+        # the SUBACK is handled by wait_msg()
+        self._pid = (self._pid % 0xFFFF) + 1
+        await self._send(SUBSCRIBE, bytes((self._pid >> 8, self._pid & 0xFF)) + _str(topic) + b'\x00')
+
+    async def ping(self):
+        await self._send(PINGREQ, b'')
+        if self.ping_sent is None:
+            self.ping_sent = self.last_tx
+
+    async def wait_msg(self):
+        """Wait for the next packet and hand PUBLISH messages to the callback."""
+        packet_type, body = await self._recv()
+        if packet_type == PINGRESP:
+            self.ping_sent = None
+        elif packet_type & 0xF0 == PUBLISH:
+            n = (body[0] << 8) | body[1]
+            topic = body[2:2+n]
+            i = 2 + n
+            if packet_type & 0x06:
+                # QoS > 0 carries a packet id, we only subscribe with QoS 0
+                i += 2
+            if self.cb:
+                self.cb(topic, body[i:])
+        return packet_type
+
+    async def close(self):
+        w = self._writer
+        self._reader = self._writer = None
+        if w is None:
+            return
+        try:
+            w.write(bytes((DISCONNECT, 0)))
+            await w.drain()
+        except Exception:
+            pass
+        w.close()
+        try:
+            await w.wait_closed()
+        except Exception:
+            pass
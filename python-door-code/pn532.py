@@ -23,13 +23,16 @@
 # SOFTWARE.
 
 from micropython import const
+import asyncio
 import machine
 import utime
+from credentials import hce_uid
 
 # from pn532uart import PN532_UART
 # import PN532
 
 # PN532 Commands
+_COMMAND_DIAGNOSE              = const(0x00)
 _WAKEUP                        = b'\x55\x55\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 _COMMAND_GETFIRMWAREVERSION    = const(0x02)
 _COMMAND_INLISTPASSIVETARGET   = const(0x4A)
@@ -37,6 +40,9 @@ _COMMAND_INRELEASE             = const(0x52)
 _COMMAND_SAMCONFIGURATION      = const(0x14)
 _COMMAND_RFCONFIGURATION       = const(0x32)
 _COMMAND_POWERDOWN             = const(0x16)
+_COMMAND_INDATAEXCHANGE        = const(0x40)
+_COMMAND_INAUTOPOLL            = const(0x60)
+_COMMAND_SETSERIALBAUDRATE     = const(0x10)
 
 # Send Frames
 _PREAMBLE                      = const(0x00)
@@ -47,46 +53,210 @@ _POSTAMBLE                     = const(0x00)
 # Message parts
 _HOSTTOPN532                   = const(0xD4)
 _PN532TOHOST                   = const(0xD5)
+_TFI_ERROR                     = const(0x7F)
 _ACK                           = b'\x00\x00\xFF\x00\xFF\x00'
+_NACK                          = b'\x00\x00\xFF\xFF\x00\x00'
 _FRAME_START                   = b'\x00\x00\xFF'
 
 # Codes
 _MIFARE_ISO14443A              = const(0x00)
 
+_TIMEOUT_MS                    = const(1000)
+# The ACK follows a command within a few ms, a lost one is not waited for long
+_ACK_TIMEOUT_MS                = const(50)
+# How often a command is sent again, or its response asked for again (NACK),
+# after a lost ACK or a garbled frame
+_RETRIES                       = const(2)
+# AsyncPN532Uart polls the uart this often (ms) while waiting for a response,
+# waits longer than _STREAM_WAIT_MS (InAutoPoll) sleep on the stream reader
+_POLL_MS                       = const(1)
+_STREAM_WAIT_MS                = const(2000)
+# Preallocated views into the RX buffer for reads at an offset
+_RX_VIEWS                      = const(8)
+
+# HSU baud rates SetSerialBaudRate can switch to, indexed by their code. The
+# PN532 starts at 115200 after a reset.
+_BAUDRATES                     = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600, 1288000)
+_DEFAULT_BAUDRATE              = const(115200)
+
+# InAutoPoll target type: generic passive 106 kbps (Mifare, ISO14443-4A and DEP)
+_AUTOPOLL_GENERIC_106A         = const(0x00)
+
+# Frames are at most 255 data bytes plus 7 bytes of framing
+_MAX_FRAME                     = const(262)
+
+# Command parameters, kept as constants so calls don't allocate
+_SAM_NORMAL_MODE               = b'\x01'
+_RF_FIELD_ON                   = b'\x01\x03'
+_RF_FIELD_OFF                  = b'\x01\x00'
+_RF_RETRIES_ONCE               = b'\x05\x00\x00\x00'
+_LIST_ONE_ISO14443A            = b'\x01\x00'
+_POWERDOWN_HSU                 = b'\x10'
+_RELEASE_ALL                   = b'\x00'
+# Diagnose NumTst 0x06: presence check of the activated ISO14443-4 target
+_DIAGNOSE_PRESENCE             = b'\x06'
+
+try:
+    # @micropython.viper checksum, not available on every port
+    from pn532_native import checksum as _checksum
+except (ImportError, SyntaxError, AttributeError):
+    def _checksum(buf, start, end):
+        s = 0
+        for i in range(start, end):
+            s += buf[i]
+        return s & 0xFF
+
+# SEL_RES bit 6: target is compliant with ISO/IEC 14443-4 (and so speaks APDUs)
+_SEL_RES_ISO14443_4            = const(0x20)
+
+# Power states tracked by PN532Uart, in increasing order of readiness
+STATE_ASLEEP                   = const(0)
+STATE_AWAKE                    = const(1)
+STATE_RF_ON                    = const(2)
+STATE_TARGET                   = const(3)
+
 class PN532Error(RuntimeError):
     pass
 
+class PassiveTarget(object):
+    """
+    A target activated by InListPassiveTarget (106 kbps type A): the logical
+    target number used for InDataExchange, SENS_RES, SEL_RES, the UID and
+    the ATS (empty unless the target is ISO14443-4 compliant).
+    """
+    def __init__(self, tg, sens_res, sel_res, uid, ats):
+        self.tg = tg
+        self.sens_res = sens_res
+        self.sel_res = sel_res
+        self.uid = uid
+        self.ats = ats
+
+    @property
+    def iso14443_4(self):
+        return bool(self.sel_res & _SEL_RES_ISO14443_4)
+
+    def __repr__(self):
+        return 'PassiveTarget(tg={}, sens_res={:04x}, sel_res={:02x}, uid={}, ats={})'.format(
+            self.tg, self.sens_res, self.sel_res, self.uid.hex(), self.ats.hex())
+
 class PN532Uart(object):
     """
     Class for interacting with the PN532 via the uart interface.
+
+    The protocol is implemented once, as generators that yield the number of
+    bytes they need next, which the runner then reads into the RX buffer.
+    PN532Uart runs them against the uart with blocking reads, AsyncPN532Uart
+    polls the uart, so the public methods of both classes are thin wrappers.
+    All reads for one phase of a command (ACK, response) share one deadline.
+
+    Frames are encoded and decoded in place in preallocated TX/RX buffers, so
+    a command only allocates the generators it runs as and the memoryview it
+    returns.
+
+    `state` tracks what the chip is doing (asleep, awake, RF on, target
+    selected). The wakeup preamble is only sent when the chip may be asleep,
+    i.e. initially, after power_down() or after a command went unanswered,
+    and the RF field is only switched on when it is not on already.
+
+    Frames are found by their start code, so stray bytes or the rest of an
+    old response only cost a resync. A lost ACK or a NACK gets the command
+    sent again, a garbled response is asked for again with a NACK, both at
+    most _RETRIES times. `errors` counts what happened, by kind.
+
+    set_baudrate() moves the link to a faster rate. When the PN532 stops
+    answering at that rate, it is looked for at 115200 (it was reset), set
+    up again and switched back to the faster rate.
     """
     def __init__(self, uart_no, tx=None, rx=None, debug=False):
         if tx and rx:
-            self.uart = machine.UART(uart_no, baudrate=115200, tx=tx, rx=rx)
+            self.uart = machine.UART(uart_no, baudrate=_DEFAULT_BAUDRATE, tx=tx, rx=rx)
         else:
-            self.uart = machine.UART(uart_no, baudrate=115200)
+            self.uart = machine.UART(uart_no, baudrate=_DEFAULT_BAUDRATE)
+        self.baudrate = _DEFAULT_BAUDRATE
 
         self.debug = debug
-        # self.swriter = asyncio.StreamWriter(self.uart, {})
-        # self.sreader = asyncio.StreamReader(self.uart)
+        # metrics.Metrics to time every command, None when tracing is off
+        self.metrics = None
+        # memstats.MemStats to count what every command allocates, or None
+        self.mem = None
+        self.timeout_ms = _TIMEOUT_MS
+        self.state = STATE_ASLEEP
+        # When the reads of the current phase give up (ticks_ms), see _expect()
+        self._deadline = 0
+        self._forever = False
+        # Bytes moved over the uart, for comparing polling strategies
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        # resync: bytes skipped to find a frame, stale: frame for another
+        # command dropped, no_ack / nack: command sent again, checksum:
+        # garbled response asked for again, rejected: error frame, relink:
+        # PN532 found back at 115200 and switched again
+        self.errors = {'resync': 0, 'stale': 0, 'no_ack': 0, 'nack': 0, 'checksum': 0, 'rejected': 0, 'relink': 0}
+        # set while the baud rate is being changed, so a failure there does
+        # not start another relink
+        self._linking = False
+
+        self._tx = bytearray(_MAX_FRAME)
+        self._txmv = memoryview(self._tx)
+        self._rx = bytearray(_MAX_FRAME)
+        self._rxmv = memoryview(self._rx)
+        self._rx_at = [self._rxmv[i:] for i in range(_RX_VIEWS)]
+        self._rx_one = [self._rxmv[i:i+1] for i in range(_RX_VIEWS)]
+        # Where the next read goes in the RX buffer (reset by every read), and
+        # how many bytes after a frame header were read together with it
+        self._rx_off = 0
+        self._ahead = 0
+        self._select_apdu_aid = None
+        self._select_params = None
+        # PollNr 0xFF: poll until a target is found, Period (x 150 ms), Type
+        self._autopoll_params = bytearray((0xFF, 0x01, _AUTOPOLL_GENERIC_106A))
 
     def wait_read_len(self, len):
-        timeout_ms = 1000
         start_time = utime.ticks_ms()
-        end_time = start_time + timeout_ms
-        while self.uart.any() < len and utime.ticks_ms() < end_time:
-            continue
-
-        if(utime.ticks_ms() >= end_time):
-            raise PN532Error('No response from PN532!')
+        while self.uart.any() < len:
+            if utime.ticks_diff(utime.ticks_ms(), start_time) >= self.timeout_ms:
+                raise PN532Error('No response from PN532!')
 
         return self.uart.read(len)
 
-    def _write_frame(self, data):
-        """Write a frame to the PN532 with the specified data bytearray."""
-        assert data is not None and 1 < len(data) < 255, 'Data must be array of 1 to 255 bytes.'
-
-        # Build frame to send as:
+    def _expect(self, wait_ms):
+        """
+        Start a phase of waiting for the PN532: the reads until the next
+        _expect() must be done within wait_ms (0: timeout_ms, None: forever).
+        """
+        self._forever = wait_ms is None
+        if wait_ms is not None:
+            self._deadline = utime.ticks_add(utime.ticks_ms(), wait_ms or self.timeout_ms)
+
+    def _readinto(self, n):
+        """Block until n bytes are available and read them into the RX buffer."""
+        uart = self.uart
+        off = self._rx_off
+        self._rx_off = 0
+        while uart.any() < n:
+            if not self._forever and utime.ticks_diff(utime.ticks_ms(), self._deadline) >= 0:
+                raise PN532Error('No response from PN532!')
+
+        uart.readinto(self._rx_at[off], n)
+        self.rx_bytes += n
+
+    def _run(self, gen):
+        """Run a protocol generator, blocking until it has finished."""
+        try:
+            n = next(gen)
+            while True:
+                try:
+                    self._readinto(n)
+                except PN532Error as e:
+                    n = gen.throw(e)
+                else:
+                    n = next(gen)
+        except StopIteration as e:
+            return e.value
+
+    def _encode_frame(self, command, params):
+        """Build a command frame in the TX buffer and return its length."""
+        # Frame layout:
         # - Preamble (0x00)
         # - Start code  (0x00, 0xFF)
         # - Command length (1 byte)
@@ -94,118 +264,238 @@ class PN532Uart(object):
         # - Command bytes
         # - Checksum
         # - Postamble (0x00)
-        length = len(data)
-        frame = bytearray(length+8)
-        frame[0] = _PREAMBLE
-        frame[1] = _STARTCODE1
-        frame[2] = _STARTCODE2
-        checksum = sum(frame[0:3])
-        frame[3] = length & 0xFF
-        frame[4] = (~length + 1) & 0xFF
-        frame[5:-2] = data
-        checksum += sum(data)
-        frame[-2] = ~checksum & 0xFF
-        frame[-1] = _POSTAMBLE
-
-        # Send frame.
+        length = len(params) + 2
+        if length > _MAX_FRAME - 7:
+            raise PN532Error('Command too long')
+
+        tx = self._tx
+        tx[0] = _PREAMBLE
+        tx[1] = _STARTCODE1
+        tx[2] = _STARTCODE2
+        tx[3] = length
+        tx[4] = (-length) & 0xFF
+        tx[5] = _HOSTTOPN532
+        tx[6] = command & 0xFF
+        for i in range(length - 2):
+            tx[7 + i] = params[i]
+        tx[5 + length] = (-_checksum(tx, 5, 5 + length)) & 0xFF
+        tx[6 + length] = _POSTAMBLE
+        return length + 7
+
+    def _write_frame(self, frame_len):
+        """Write the frame in the TX buffer to the PN532."""
+        uart = self.uart
+
         if self.debug:
-            print('_write_frame: ', [hex(i) for i in frame])
+            print('_write_frame: ', bytes(self._txmv[:frame_len]).hex())
+
+        # The chip only needs waking up when it may be asleep
+        if self.state == STATE_ASLEEP:
+            uart.write(_WAKEUP)
+            self.tx_bytes += len(_WAKEUP)
 
         # HACK! Timeouts can cause there to be data in the read buffer that was for an old command (ie read_passive_target).
-        # Additonally, the device needs to be woken sometimes, and it seems safe to do that before every command.
-        # TODO: Does WAKEUP cancel the passive read_command?
         # Before sending the real command, clear the read buffer
-        self.uart.write(_WAKEUP)
 
-        waiting = self.uart.any()
-        while waiting > 0:
+        # At most two frames are dropped, so a reader that keeps babbling
+        # cannot hold up the other tasks here.
+        waiting = uart.any()
+        drained = 0
+        while waiting > 0 and drained < 2 * _MAX_FRAME:
             if self.debug:
-                print("Removing %d bytes in the read buffer")
-            self.uart.read(waiting)
-            waiting = self.uart.any()
+                print("Removing %d bytes in the read buffer" % waiting)
+            drained += uart.readinto(self._rx, min(waiting, _MAX_FRAME))
+            waiting = uart.any()
 
-        self.uart.write(bytes(frame))
+        uart.write(self._txmv[:frame_len])
         #self.uart.flush()
+        self.tx_bytes += frame_len
 
-        ack = self.wait_read_len(len(_ACK))
-
-        if self.debug:
-            print('_write_frame: ACK: ', [hex(i) for i in ack])
-        if ack != _ACK:
-            raise PN532Error('Did not receive expected ACK from PN532!')
-
-    def _read_frame(self):
+    def _read_header(self, first):
         """
-        Read a response frame from the PN532 and return the data inside the frame,
-        otherwise raises an exception if there is an error parsing the frame.
+        Read a frame header into rx[0:5] (00 00 FF LEN LCS) and return LEN,
+        0 for an ACK, -1 for a NACK or -2 when LEN and LCS do not match. `first` bytes are
+        read at once, self._ahead counts those of them that followed the
+        header (left in rx[5:]). Anything before the start code is skipped.
         """
-        # Read the Frame start and header
-        response = self.wait_read_len(len(_FRAME_START)+2)
-        if self.debug:
-            print('_read_frame: frame_start + header:', [hex(i) for i in response])
+        rx = self._rx
+        yield first
+        n = first
+        if rx[0] != 0x00 or rx[1] != 0x00 or rx[2] != 0xFF:
+            self.errors['resync'] += 1
+            i = 0
+            while i < n - 1 and not (rx[i] == 0x00 and rx[i+1] == 0xFF):
+                i += 1
+            if i == n - 1:
+                # Not in what we have, slide a two byte window over the stream.
+                # The last byte may be the 00 of the start code.
+                rx[0] = rx[n-1]
+                skipped = n - 1
+                while True:
+                    self._rx_off = 1
+                    yield 1
+                    if rx[0] == 0x00 and rx[1] == 0xFF:
+                        break
+                    skipped += 1
+                    if skipped > 2 * _MAX_FRAME:
+                        raise PN532Error('Lost frame sync')
+                    rx[0] = rx[1]
+                i = 0
+                n = 2
+
+            # move what followed the start code to rx[3:]
+            t = n - i - 2
+            if i == 0:
+                for k in range(t - 1, -1, -1):
+                    rx[3+k] = rx[2+k]
+            else:
+                for k in range(t):
+                    rx[3+k] = rx[i+2+k]
+            rx[0] = 0x00
+            rx[1] = 0x00
+            rx[2] = 0xFF
+            if t < 2:
+                self._rx_off = 3 + t
+                yield 2 - t
+                t = 2
+            n = t + 3
+
+        self._ahead = n - 5
+        length = rx[3]
+        if length == 0x00 and rx[4] == 0xFF:
+            return 0
+        if length == 0xFF and rx[4] == 0x00:
+            return -1
+        if length == 0 or (length + rx[4]) & 0xFF:
+            return -2
+        return length
+
+    def _call_function(self, command, params=b'', response_timeout_ms=0):
+        # Send the frame and read the ACK. Until the PN532 answered assume the
+        # worst, so an unanswered command gets the next one a wakeup. The ACK
+        # comes within a few ms, a lost one is not waited for long.
+        metrics = self.metrics
+        if metrics:
+            t = metrics.start()
+        mem = self.mem
+        if mem:
+            m = mem.start()
+        errors = self.errors
+        rx = self._rx
+        frame_len = self._encode_frame(command, params)
+        state = self.state if self.state > STATE_AWAKE else STATE_AWAKE
+        tries = 0
+        while True:
+            self._write_frame(frame_len)
+            self.state = STATE_ASLEEP
+            tries += 1
+            self._expect(_ACK_TIMEOUT_MS)
+            try:
+                n = yield from self._read_header(len(_ACK))
+                if n == 0:
+                    if not self._ahead:
+                        # the postamble
+                        self._rx_off = 5
+                        yield 1
+                    n = None
+                    break
+                if n > 0:
+                    # A frame instead of the ACK: the response, if only the
+                    # ACK was lost, or a late one to an earlier command
+                    break
+                errors['nack' if n == -1 else 'checksum'] += 1
+            except PN532Error:
+                errors['no_ack'] += 1
+            if tries > _RETRIES:
+                if self.baudrate == _DEFAULT_BAUDRATE or self._linking:
+                    raise PN532Error('Did not receive expected ACK from PN532!')
+                # A reset PN532 is back at 115200, find it there and try again
+                yield from self._relink()
+                frame_len = self._encode_frame(command, params)
+                # the reset PN532 lost what the state said, the relink set it up
+                state = self.state if self.state > STATE_AWAKE else STATE_AWAKE
+                tries = 0
+
+        # Read the frame start and header, then the data + checksum + postamble.
+        # Commands like InAutoPoll only answer once something happened, they
+        # pass their own response timeout (None: forever) and get None back
+        # when it expires.
+        if n is None:
+            self._expect(response_timeout_ms)
+            try:
+                n = yield from self._read_header(len(_FRAME_START) + 2)
+            except PN532Error:
+                if response_timeout_ms == 0:
+                    raise
+                self.state = state
+                return None
+
+        # A garbled response is asked for again with a NACK, frames for
+        # another command are dropped.
+        self._expect(0)
+        tries = 0
+        while True:
+            if n > 0:
+                # data, checksum and postamble into rx[0:n+2]
+                ahead = self._ahead
+                for i in range(ahead):
+                    rx[i] = rx[5+i]
+                self._rx_off = ahead
+                yield n + 2 - ahead
+                if self.debug:
+                    print('_read_frame: data: ', bytes(self._rxmv[:n+2]).hex())
+                if _checksum(rx, 0, n + 1) != 0 or rx[n+1] != 0x00:
+                    n = -2
+                elif n >= 2 and rx[0] == _PN532TOHOST and rx[1] == command + 1:
+                    break
+                elif n == 1 and rx[0] == _TFI_ERROR:
+                    errors['rejected'] += 1
+                    raise PN532Error('PN532 rejected the command')
+                else:
+                    errors['stale'] += 1
+            elif n == 0:
+                # the ACK, when the response came first
+                if not self._ahead:
+                    self._rx_off = 5
+                    yield 1
+            if n < 0:
+                errors['checksum'] += 1
+            tries += 1
+            if tries > _RETRIES:
+                raise PN532Error('No valid response from PN532!')
+            if n < 0:
+                self.uart.write(_NACK)
+                self.tx_bytes += len(_NACK)
+            self._expect(0)
+            n = yield from self._read_header(len(_FRAME_START) + 2)
+
+        self.state = state
+        if metrics:
+            metrics.stop_command(command, t)
+        if mem:
+            mem.stop('pn532.call', m)
 
-        if len(response) < (len(_FRAME_START) + 2) or response[:-2] != _FRAME_START:
-            raise PN532Error('Response does not begin with _FRAME_START!')
-
-        # Read the header (length & length checksum) and make sure they match.
-        frame_len = response[-2]
-        frame_checksum = response[-1]
-        if (frame_len + frame_checksum) & 0xFF != 0:
-            raise PN532Error('Response length checksum did not match length!')
-
-        # read the frame (data + data checksum + end frame) & validate
-        data = self.wait_read_len(frame_len+2)
-
-        if self.debug:
-            print('_read_frame: data: ', [hex(i) for i in data])
-
-        checksum = sum(data) & 0xFF
-        if checksum != 0:
-            raise PN532Error('Response checksum did not match expected value: ', checksum)
-
-        if data[-1] != 0x00:
-            raise PN532Error('Response does not include Frame End')
-
-        # Return frame data.
-        return data[0:frame_len]
+        # Return response data.
+        return self._rxmv[2:n]
 
-    def call_function(self, command, params=[]):
+    def call_function(self, command, params=b''):
         """
         Send specified command to the PN532 and return the response.
-        Note: There is no timeout option. Use async.wait_for(function(), timeout) instead
+        Raises PN532Error if the PN532 does not answer within timeout_ms.
+        The response is a memoryview into the RX buffer, it is only valid
+        until the next command.
         """
-        data = bytearray(2 + len(params))
-        data[0] = _HOSTTOPN532
-        data[1] = command & 0xFF
-        for i, val in enumerate(params):
-            data[2+i] = val
-
-        # Send the frame and read the response
-        self._write_frame(data)
-        response = self._read_frame()
-
-        if len(response) < 2:
-            raise PN532Error('Received smaller than expected frame')
-
-        if not(response[0] == _PN532TOHOST and response[1] == (command+1)):
-            raise PN532Error('Received unexpected command response!')
+        return self._run(self._call_function(command, params))
 
-        # Return response data.
-        return response[2:]
-
-    def SAM_configuration(self):
+    def _SAM_configuration(self):
         if self.debug:
             print("Sending SAM_CONFIGURATION")
 
-        response = self.call_function(_COMMAND_SAMCONFIGURATION, params=[0x01])
+        response = yield from self._call_function(_COMMAND_SAMCONFIGURATION, _SAM_NORMAL_MODE)
         if self.debug:
-            print('SAM_configuration:', response.hex())
+            print('SAM_configuration:', bytes(response).hex())
 
-        # Enable RF:
-        #   0x32 - Cmd: RFConfiguration
-        #   0x01 - Item: RF Field
-        #   0x03 - AutoRFCA=on, RF=on
-        self.call_function(_COMMAND_RFCONFIGURATION, params=[0x01, 0x03])
+        yield from self._enable_rf()
 
         # Return imidiately aftery trying once:
         #   0x32 - Cmd: RFConfiguration
@@ -213,102 +503,370 @@ class PN532Uart(object):
         #   0x00 - 0 retries (1 try)
         #   0x00 - 0 retries (1 try)
         #   0x00 - 0 retries (1 try)
-        self.call_function(_COMMAND_RFCONFIGURATION, params=[0x05, 0x00, 0x00, 0x00])
+        yield from self._call_function(_COMMAND_RFCONFIGURATION, _RF_RETRIES_ONCE)
 
-    def get_firmware_version(self):
+    def SAM_configuration(self):
+        return self._run(self._SAM_configuration())
+
+    def _enable_rf(self):
+        # Enable RF:
+        #   0x32 - Cmd: RFConfiguration
+        #   0x01 - Item: RF Field
+        #   0x03 - AutoRFCA=on, RF=on
+        yield from self._call_function(_COMMAND_RFCONFIGURATION, _RF_FIELD_ON)
+        self.state = STATE_RF_ON
+
+    def _set_uart_baudrate(self, baudrate):
+        self.uart.init(baudrate=baudrate)
+        self.baudrate = baudrate
+
+    def _switch_baudrate(self, baudrate):
+        # SetSerialBaudRate is answered at the old rate. The PN532 switches
+        # once the host acknowledged the response, wait until the ACK is out.
+        yield from self._call_function(_COMMAND_SETSERIALBAUDRATE, bytes((_BAUDRATES.index(baudrate),)))
+        self._confirm_baudrate(baudrate)
+
+    def _confirm_baudrate(self, baudrate):
+        self.uart.write(_ACK)
+        self.tx_bytes += len(_ACK)
+        utime.sleep_ms(1 + 10 * len(_ACK) * 1000 // self.baudrate)
+        self._set_uart_baudrate(baudrate)
+
+    def _set_baudrate(self, baudrate):
+        if baudrate not in _BAUDRATES:
+            raise PN532Error('Unsupported baud rate: {}'.format(baudrate))
+        old = self.baudrate
+        if baudrate == old:
+            return True
+        self._linking = True
+        try:
+            yield from self._switch_baudrate(baudrate)
+            try:
+                yield from self._get_firmware_version()
+                return True
+            except PN532Error:
+                pass
+
+            # No answer at the new rate. Should the PN532 have switched, ask it
+            # to come back: it may well hear us even if we cannot read it, so
+            # the switch is confirmed without waiting for its answer. Then
+            # make sure it answers at the old rate.
+            if self.debug:
+                print('No answer at {} baud, back to {}'.format(baudrate, old))
+            try:
+                yield from self._switch_baudrate(old)
+            except PN532Error:
+                self._confirm_baudrate(old)
+            self.state = STATE_ASLEEP
+            yield from self._get_firmware_version()
+            return False
+        finally:
+            self._linking = False
+
+    def set_baudrate(self, baudrate):
         """
-        Call PN532 GetFirmwareVersion function and return a tuple with the IC,
-        Ver, Rev, and Support values.
+        Switch the PN532 and the uart to `baudrate` (up to 1288000) and check
+        the link with GetFirmwareVersion. Returns False if the PN532 did not
+        answer at the new rate and the link is back at the old one.
         """
+        return self._run(self._set_baudrate(baudrate))
+
+    def _relink(self):
+        # The PN532 stopped answering at the negotiated rate. If it answers at
+        # 115200 it was reset: set it up again and switch back. Otherwise it
+        # is not answering at all, keep the negotiated rate.
+        baudrate = self.baudrate
+        self._set_uart_baudrate(_DEFAULT_BAUDRATE)
+        self.state = STATE_ASLEEP
+        self._linking = True
+        try:
+            yield from self._get_firmware_version()
+        except PN532Error:
+            self._set_uart_baudrate(baudrate)
+            raise
+        finally:
+            self._linking = False
+        self.errors['relink'] += 1
+        if self.debug:
+            print('PN532 was reset, switching to {} baud again'.format(baudrate))
+        yield from self._SAM_configuration()
+        yield from self._set_baudrate(baudrate)
+
+    def _get_firmware_version(self):
         if self.debug:
             print("Sending GET_FIRMWARE_VERSION")
 
-        response = self.call_function(_COMMAND_GETFIRMWAREVERSION)
+        response = yield from self._call_function(_COMMAND_GETFIRMWAREVERSION)
         if response is None:
             raise PN532Error('Failed to detect the PN532')
         return tuple(response)
 
-    def read_passive_target(self, card_baud=_MIFARE_ISO14443A):
+    def get_firmware_version(self):
         """
-        Wait for a MiFare card to be available and return its UID when found.
-        Will wait up to timeout seconds and return None if no card is found,
-        otherwise a bytearray with the UID of the found card is returned.
+        Call PN532 GetFirmwareVersion function and return a tuple with the IC,
+        Ver, Rev, and Support values.
         """
+        return self._run(self._get_firmware_version())
 
-        # Enable RF:
-        #   0x32 - Cmd: RFConfiguration
-        #   0x01 - Item: RF Field
-        #   0x03 - AutoRFCA=on, RF=on
-        self.call_function(_COMMAND_RFCONFIGURATION, params=[0x01, 0x03])
+    def _read_passive_target(self, card_baud=_MIFARE_ISO14443A):
+        if self.state < STATE_RF_ON:
+            yield from self._enable_rf()
 
         if self.debug:
             print("Sending INIT_PASSIVE_TARGET")
         # Send passive read command for 1 card.  Expect at most a 7 byte UUID.
-        response = self.call_function(_COMMAND_INLISTPASSIVETARGET, params=[0x01, card_baud])
+        params = _LIST_ONE_ISO14443A if card_baud == _MIFARE_ISO14443A else bytes((0x01, card_baud))
+        response = yield from self._call_function(_COMMAND_INLISTPASSIVETARGET, params)
 
         # Check only 1 card with up to a 7 byte UID is present.
+        self.state = STATE_RF_ON
         if response[0] == 0x00:
             return None
         if response[0] > 0x01:
             raise PN532Error('More than one card detected!')
-        if response[5] > 7:
+        uid_len = response[5]
+        if uid_len > 7:
             raise PN532Error('Found card with unexpectedly long UID!')
 
-        # Return UID of card.
-        return response[6:6+response[5]]
+        self.state = STATE_TARGET
+        return self._parse_target(response, 1, len(response))
 
-    def power_down(self):
+    def _parse_target(self, response, start, end):
+        # Target data: Tg, SENS_RES (2), SEL_RES, NFCIDLength, NFCID1, [ATS]
+        # The ATS length byte counts itself, it is not part of the returned ATS.
+        uid_end = start + 5 + response[start+4]
+        ats = b''
+        if end > uid_end:
+            ats = bytes(response[uid_end+1:uid_end+response[uid_end]])
+        return PassiveTarget(response[start], (response[start+1] << 8) | response[start+2], response[start+3],
+                             bytes(response[start+5:uid_end]), ats)
+
+    def read_passive_target(self, card_baud=_MIFARE_ISO14443A):
+        """
+        Look for a MiFare card once and return it as a PassiveTarget, the
+        card stays activated so it can be used with select_aid(). Returns None
+        if no card is found.
+        """
+        return self._run(self._read_passive_target(card_baud))
+
+    def _auto_poll(self, period, timeout_ms):
+        if self.state < STATE_RF_ON:
+            yield from self._enable_rf()
+
+        if self.debug:
+            print("Sending IN_AUTO_POLL")
+        params = self._autopoll_params
+        params[1] = period
+        response = yield from self._call_function(_COMMAND_INAUTOPOLL, params, timeout_ms)
+        if response is None:
+            # Nothing showed up: an ACK frame aborts the running poll
+            self.uart.write(_ACK)
+            self.tx_bytes += len(_ACK)
+            return None
+
+        # NbTg, then Type, Length and the same target data as InListPassiveTarget
+        self.state = STATE_RF_ON
+        if response[0] == 0x00:
+            return None
+        self.state = STATE_TARGET
+        return self._parse_target(response, 3, 3 + response[2])
+
+    def auto_poll(self, period=1, timeout_ms=60000):
+        """
+        Let the PN532 poll for a card by itself every period x 150 ms and
+        return it as an activated PassiveTarget. Returns None if no card
+        showed up within timeout_ms (None waits forever).
+        """
+        return self._run(self._auto_poll(period, timeout_ms))
+
+    def _power_down(self):
         # Disable RF:
         #   0x32 - Cmd: RFConfiguration
         #   0x01 - Item: RF Field
         #   0x00 - AutoRFCA=off, RF=off
-        self.call_function(_COMMAND_RFCONFIGURATION, params=[0x01, 0x00])
+        if self.state >= STATE_RF_ON:
+            yield from self._call_function(_COMMAND_RFCONFIGURATION, _RF_FIELD_OFF)
+            self.state = STATE_AWAKE
 
         # Power down
         #   0x16 - Cmd: PowerDown
         #   0x10 - WakeUpEnable: 5 bit - HSU (UART)
-        self.call_function(_COMMAND_POWERDOWN, params=[0x10])
+        yield from self._call_function(_COMMAND_POWERDOWN, _POWERDOWN_HSU)
+        self.state = STATE_ASLEEP
 
-    def release_targets(self):
+    def power_down(self):
+        return self._run(self._power_down())
+
+    def _release_targets(self):
         if self.debug:
             print("Release Targets")
-        response = self.call_function(_COMMAND_INRELEASE, params=[0x00])
+        yield from self._call_function(_COMMAND_INRELEASE, _RELEASE_ALL)
+        if self.state == STATE_TARGET:
+            self.state = STATE_RF_ON
 
-    def read_hce_uid(self, aid_hex):
-        """
-        Try to communicate with a Type 4A (Android HCE) tag by sending a SELECT AID APDU.
-        Returns the UID string from the app, or None if not present.
-        """
-        # Enable RF
-        self.call_function(_COMMAND_RFCONFIGURATION, params=[0x01, 0x03])
+    def release_targets(self):
+        return self._run(self._release_targets())
+
+    def _select_aid_params(self, tg, aid_hex):
+        # InDataExchange: Tg, then the SELECT AID APDU: 00 A4 04 00 <len> <AID>
+        # The APDU is built once per AID.
+        if aid_hex != self._select_apdu_aid:
+            aid_bytes = bytes.fromhex(aid_hex)
+            self._select_params = bytearray((0x00, 0x00, 0xA4, 0x04, 0x00, len(aid_bytes))) + aid_bytes
+            self._select_apdu_aid = aid_hex
+        self._select_params[0] = tg
+        return self._select_params
+
+    def _select_aid(self, target, aid_hex):
         if self.debug:
-            print("Sending INIT_PASSIVE_TARGET for HCE")
+            print("Sending SELECT AID to target", target.tg)
         try:
-            response = self.call_function(_COMMAND_INLISTPASSIVETARGET, params=[0x01, _MIFARE_ISO14443A])
+            response = yield from self._call_function(_COMMAND_INDATAEXCHANGE, self._select_aid_params(target.tg, aid_hex))
         except PN532Error:
             return None
-        if response[0] == 0x00:
+        # Status byte, then the APDU response: the UID from the app and status
+        # word 90 00. Any other status word (6A 82 from a DESFire or bank card
+        # without our app) or a bare status word is no phone of ours, the
+        # caller falls back to the card's UID.
+        n = len(response)
+        if n < 4 or response[0] & 0x3F != 0x00 or response[n-2] != 0x90 or response[n-1] != 0x00:
             return None
-        # Type 4A tag (Android HCE) will have SENS_RES = 0x44 0x00 and SEL_RES = 0x20
-        # See NFC Forum Digital Protocol spec for details
-        # We assume any card here could be HCE, so try APDU
-        # Send SELECT AID APDU: 00 A4 04 00 <len> <AID>
-        aid_bytes = bytearray.fromhex(aid_hex)
-        apdu = bytearray([0x00, 0xA4, 0x04, 0x00, len(aid_bytes)]) + aid_bytes
-        # InDataExchange command: 0x40, 0x01 (target 1), then APDU
-        params = [0x40, 0x01] + list(apdu)
+        return hce_uid(response[1:n-2])
+
+    def select_aid(self, target, aid_hex):
+        """
+        Send a SELECT AID APDU to an already activated target and return the
+        UID string from the app, or None if it did not answer.
+        """
+        return self._run(self._select_aid(target, aid_hex))
+
+    def _check_target(self, target):
+        if target.iso14443_4:
+            # The PN532 pings the target with an R(NAK) block, the target
+            # stays selected. Status 0x00: it answered.
+            response = yield from self._call_function(_COMMAND_DIAGNOSE, _DIAGNOSE_PRESENCE)
+            if len(response) and response[0] & 0x3F == 0x00:
+                return True
+            self.state = STATE_RF_ON
+            return False
+        # A Mifare card cannot be pinged without authenticating, it is
+        # listed again. Its UID does not change, unlike a phone's.
+        found = yield from self._read_passive_target()
+        return found is not None and found.uid == target.uid
+
+    def check_target(self, target):
+        """
+        Return whether an activated target is still in the field, without
+        activating it again if it speaks ISO14443-4.
+        """
+        return self._run(self._check_target(target))
+
+    def _read_hce_uid(self, aid_hex):
         try:
-            apdu_response = self.call_function(0x40, params)
+            target = yield from self._read_passive_target()
         except PN532Error:
             return None
-        # The response should be the UID string (hex) from the app, possibly with status word 0x9000 at the end
-        if not apdu_response:
+        if target is None or not target.iso14443_4:
             return None
-        # Remove trailing status word if present (0x90 0x00)
-        if len(apdu_response) >= 2 and apdu_response[-2:] == b'\x90\x00':
-            apdu_response = apdu_response[:-2]
-        # Return as string
+        return (yield from self._select_aid(target, aid_hex))
+
+    def read_hce_uid(self, aid_hex):
+        """
+        Try to communicate with a Type 4A (Android HCE) tag by sending a SELECT AID APDU.
+        Returns the UID string from the app, or None if not present.
+        Prefer read_passive_target() + select_aid(), which activates the target once.
+        """
+        return self._run(self._read_hce_uid(aid_hex))
+
+
+class AsyncPN532Uart(PN532Uart):
+    """
+    PN532Uart for use inside an asyncio loop. While waiting for the PN532 the
+    uart is polled every _POLL_MS, yielding to the scheduler in between, and
+    long waits sleep on a stream reader over the uart. Every command is a
+    coroutine.
+    """
+    def __init__(self, uart_no, tx=None, rx=None, debug=False):
+        super().__init__(uart_no, tx=tx, rx=rx, debug=debug)
+        self.sreader = asyncio.StreamReader(self.uart)
+
+    async def wait_read_len(self, len):
         try:
-            return apdu_response.decode('ascii')
-        except Exception:
-            return apdu_response.hex()
+            return await asyncio.wait_for(self.sreader.readexactly(len), self.timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            raise PN532Error('No response from PN532!')
+
+    async def _readinto(self, n):
+        uart = self.uart
+        off = self._rx_off
+        self._rx_off = 0
+        if uart.any() < n and (self._forever or
+                               utime.ticks_diff(self._deadline, utime.ticks_ms()) > _STREAM_WAIT_MS):
+            # A long wait (InAutoPoll): sleep on the stream reader until the
+            # first byte instead of polling, the rest follows within ms
+            try:
+                if self._forever:
+                    got = await self.sreader.readinto(self._rx_one[off])
+                else:
+                    got = await asyncio.wait_for(self.sreader.readinto(self._rx_one[off]),
+                                                 utime.ticks_diff(self._deadline, utime.ticks_ms()) / 1000)
+            except asyncio.TimeoutError:
+                raise PN532Error('No response from PN532!')
+            self.rx_bytes += got
+            off += got
+            n -= got
+        # Poll the uart until the deadline of the current phase, the views
+        # into the RX buffer are preallocated
+        while uart.any() < n:
+            if not self._forever and utime.ticks_diff(utime.ticks_ms(), self._deadline) >= 0:
+                raise PN532Error('No response from PN532!')
+            await asyncio.sleep_ms(_POLL_MS)
+        if n:
+            uart.readinto(self._rx_at[off], n)
+            self.rx_bytes += n
+
+    async def _run(self, gen):
+        try:
+            n = next(gen)
+            while True:
+                try:
+                    await self._readinto(n)
+                except PN532Error as e:
+                    n = gen.throw(e)
+                else:
+                    n = next(gen)
+        except StopIteration as e:
+            return e.value
+
+    async def call_function(self, command, params=b''):
+        return await self._run(self._call_function(command, params))
+
+    async def SAM_configuration(self):
+        return await self._run(self._SAM_configuration())
+
+    async def set_baudrate(self, baudrate):
+        return await self._run(self._set_baudrate(baudrate))
+
+    async def get_firmware_version(self):
+        return await self._run(self._get_firmware_version())
+
+    async def read_passive_target(self, card_baud=_MIFARE_ISO14443A):
+        return await self._run(self._read_passive_target(card_baud))
+
+    async def auto_poll(self, period=1, timeout_ms=60000):
+        return await self._run(self._auto_poll(period, timeout_ms))
+
+    async def power_down(self):
+        return await self._run(self._power_down())
+
+    async def release_targets(self):
+        return await self._run(self._release_targets())
+
+    async def select_aid(self, target, aid_hex):
+        return await self._run(self._select_aid(target, aid_hex))
+
+    async def check_target(self, target):
+        return await self._run(self._check_target(target))
+
+    async def read_hce_uid(self, aid_hex):
+        return await self._run(self._read_hce_uid(aid_hex))
@@ -0,0 +1,15 @@
+# Native code helpers for pn532.py, compiled with the viper emitter.
+# Kept in a separate module so ports without viper fall back to pure Python.
+
+import micropython
+
+
+@micropython.viper
+def checksum(buf, start: int, end: int) -> int:
+    p = ptr8(buf)
+    s = 0
+    i = start
+    while i < end:
+        s += p[i]
+        i += 1
+    return s & 0xFF
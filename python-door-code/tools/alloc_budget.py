@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Allocation budgets for the hot paths.
+
+Runs each path many times and compares the most it allocated in one call
+with its budget, exits 1 when a path is over. Run it after touching the frame
+codec or the lookup path, a new allocation there shows up as a failure:
+
+    python tools/alloc_budget.py [iterations]
+
+On the device copy it next to the firmware and run it with `import
+alloc_budget` (or mpremote run), it raises SystemExit(1) when a path is over.
+
+Paths (PN532 against bench_pn532's loopback reader under CPython):
+
+    pn532.encode     building a command frame in the TX buffer
+    pn532.call       a whole command: frame out, ACK and response parsed
+    hashdb.set       a HashStore lookup, database cached in a set
+    hashdb.bloom     a HashStore lookup through the Bloom filter and flash
+    authcache        a DecisionCache hit
+
+The budgets are what the design allows, not what the code happens to use:
+nothing, except that a PN532 command runs as generators and returns a
+memoryview of the RX buffer. Those objects are created by themselves at
+startup and measured on the running interpreter, which makes the
+pn532.call budget. On the device bytes per call are gc.mem_alloc
+differences with the GC disabled, so any new allocation fails. Under
+CPython they are tracemalloc peaks, and every path may also use
+_CPYTHON_SCALARS bytes of boxed ints and loop iterators, which MicroPython
+keeps off the heap. A new object smaller than what a path leaves of that
+allowance is only caught on the device.
+"""
+
+import sys
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+
+if not MICROPYTHON:
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # sets up the loopback reader
+    import bench_pn532  # noqa: F401
+
+import gc  # noqa: E402
+import hashdb  # noqa: E402
+from authcache import DecisionCache  # noqa: E402
+from pn532 import PN532Uart  # noqa: E402
+
+# CPython boxes ints above 256 and allocates the iterators of for loops, up
+# to 48 bytes each, a path may hold four of them at once
+_CPYTHON_SCALARS = 4 * 48
+
+_COMMAND_GETFIRMWAREVERSION = 0x02
+# frame start + LEN + LCS, what _call_function reads as a header
+_HEADER_LEN = 5
+
+
+def _digest(i):
+    return bytes((i * 37 + j) & 0xFF for j in range(32))
+
+
+def _paths(rf, db_set, db_bloom, cache, digest, params):
+    return {
+        'pn532.encode': lambda: rf._encode_frame(_COMMAND_GETFIRMWAREVERSION, params),
+        'pn532.call': lambda: rf.call_function(_COMMAND_GETFIRMWAREVERSION),
+        'hashdb.set': lambda: db_set.contains(digest),
+        'hashdb.bloom': lambda: db_bloom.contains(digest),
+        'authcache': lambda: cache.contains(digest),
+    }
+
+
+def _command_objects(rf):
+    """
+    What a PN532 command may allocate, alive at the same time: the
+    _call_function generator, the _read_header generator it runs, the
+    memoryview it returns and the StopIteration that carries it out.
+    """
+    command = rf._call_function(_COMMAND_GETFIRMWAREVERSION, b'')
+    header = rf._read_header(_HEADER_LEN)
+    response = rf._rxmv[2:4]
+    return command, header, StopIteration(response)
+
+
+def budgets(rf, measure):
+    command = measure(lambda: _command_objects(rf), 20)
+    allowed = {
+        'pn532.encode': 0,
+        'pn532.call': command,
+        'hashdb.set': 0,
+        'hashdb.bloom': 0,
+        'authcache': 0,
+    }
+    if not MICROPYTHON:
+        for name in allowed:
+            allowed[name] += _CPYTHON_SCALARS
+    return allowed
+
+
+def measure_cpython(fn, n):
+    import tracemalloc
+    tracemalloc.start()
+    peak = 0
+    for _ in range(n):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return peak
+
+
+def measure_micropython(fn, n):
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        for _ in range(n):
+            fn()
+        return (gc.mem_alloc() - before) // n
+    finally:
+        gc.enable()
+
+
+def _temp_dir():
+    if MICROPYTHON:
+        # no tempfile on the device, the file is removed again below
+        return ''
+    import tempfile
+    return tempfile.mkdtemp()
+
+
+def main(n=200):
+    tmp = _temp_dir()
+    db_file = tmp + '/alloc_budget.db' if tmp else 'alloc_budget.db.tmp'
+    # 300 digests: a set with the default budget, a Bloom filter with 1 KB
+    digests = [_digest(i) for i in range(300)]
+    hashdb.write_db(db_file, digests, 1)
+    db_set = hashdb.HashStore(db_file, mem_budget=32 * 1024)
+    db_bloom = hashdb.HashStore(db_file, mem_budget=1024)
+    cache = DecisionCache(db_set)
+    digest = digests[7]
+    measure = measure_micropython if MICROPYTHON else measure_cpython
+    try:
+        rf = PN532Uart(2, rx=19, tx=22) if MICROPYTHON else PN532Uart(2)
+        allowed = budgets(rf, measure)
+        paths = _paths(rf, db_set, db_bloom, cache, digest, b'\x01\x03')
+        failed = 0
+        for name, fn in paths.items():
+            # the first call may build caches
+            fn()
+            used = measure(fn, n)
+            budget = allowed[name]
+            over = used > budget
+            failed += over
+            print('{:14} {:6} bytes/call  budget {:6}  {}'.format(name, used, budget, 'OVER' if over else 'ok'))
+    finally:
+        db_bloom.close()
+        db_set.close()
+        import os
+        os.remove(db_file)
+        if tmp:
+            os.rmdir(tmp)
+    return failed
+
+
+if MICROPYTHON:
+    if main(100):
+        sys.exit(1)
+elif __name__ == '__main__':
+    sys.exit(1 if main(int(sys.argv[1]) if len(sys.argv) > 1 else 200) else 0)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the lock firmware on the CPython emulator.
+
+Runs main.py's Nfc.loop and handle_auth unchanged against the simulated
+PN532, keypad and door pin from emulator.py and reports, for each polling
+engine (NFC_MODE):
+
+    mifare   tap-to-prompt and tap-to-unlock latency percentiles for an
+             enrolled card, the PIN is typed as soon as the keypad asks
+    hce      the same for an enrolled phone running the HCE app
+    no-card  UART bytes per poll cycle and bytes per second while idle
+    queue    users per minute through the door when enrolled card holders
+             queue up: each steps up and taps while the one before is typing
+             the PIN (PIN_THINK_MS, then PIN_KEY_MS a key)
+
+plus the CPU busy time (process time / wall time) of every scenario. The
+tap-to-unlock latency includes reading the PIN from the keypad.
+
+    python tools/bench_e2e.py [--taps N] [--idle SECONDS] [--users N]
+                              [--mode poll|autopoll] [--baudrate RATE]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+
+import emulator
+
+board = emulator.install()
+
+import machine  # noqa: E402
+import credentials  # noqa: E402
+import hashdb  # noqa: E402
+import main  # noqa: E402
+from hashdb_compile import card_uid  # noqa: E402
+
+MIFARE_UID = '04a1b2c3'
+MIFARE_PIN = '1234'
+PHONE_ID = '3F2A11BC0D99'
+PHONE_PIN = '5678'
+
+# Card holders of the queue scenario: UIDs, how long they look at the keypad
+# before typing and how fast they type, how long (s) the next one takes to
+# step up
+QUEUE_UID = '05{:06x}'
+PIN_THINK_MS = 800
+PIN_KEY_MS = 200
+STEP_UP = 0.3
+
+# InAutoPoll period used by Nfc._autopoll, in seconds
+_AUTOPOLL_PERIOD = 0.15
+
+
+class _Events:
+    def send_event(self, name, payload):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def make_db(path, users):
+    digests = [
+        credentials.generate_digest(card_uid(credentials.CARD_MIFARE, MIFARE_UID), MIFARE_PIN),
+        credentials.generate_digest(card_uid(credentials.CARD_ANDROID, PHONE_ID), PHONE_PIN),
+    ]
+    for i in range(users):
+        digests.append(credentials.generate_digest(card_uid(credentials.CARD_MIFARE, QUEUE_UID.format(i)), MIFARE_PIN))
+    hashdb.write_db(path, digests, 1)
+
+
+async def _wait_level(pin, level, since, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for t, v in pin.history:
+            if t >= since and v == level:
+                return t
+        await asyncio.sleep(0.005)
+    return None
+
+
+class Run:
+    def __init__(self, mode, db_path, baudrate):
+        self.pn532 = emulator.SimPN532()
+        self.keypad = emulator.ScriptedKeypad()
+        self.rf_uart = board.attach(2, self.pn532)
+        board.attach(1, self.keypad, 9600)
+
+        self.nfc = main.Nfc(mode, baudrate=baudrate)
+        self.door_pin = machine.Pin(2, machine.Pin.OUT)
+        self.door = main.Door(self.door_pin)
+        self.db = hashdb.HashStore(db_path)
+        self._tasks = []
+
+    async def start(self):
+        keypad = main.Keypad(machine.UART(1, baudrate=9600))
+        self._tasks = [
+            asyncio.create_task(keypad.loop()),
+            asyncio.create_task(self.door.loop()),
+            asyncio.create_task(main.handle_auth(self.nfc, keypad, self.door, _Events(), self.db)),
+            asyncio.create_task(self.nfc.loop()),
+        ]
+        # let the reader be configured and settle into its polling loop
+        await asyncio.sleep(0.5)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def tap(self, card, pin):
+        """Present `card`, type `pin` when asked, return (prompt, unlock) in ms."""
+        await asyncio.sleep(random.uniform(0, 0.3))
+        self.keypad.pins.append(pin)
+        t0 = time.monotonic()
+        self.pn532.place(card)
+
+        unlocked = await _wait_level(self.door_pin, 1, t0)
+        self.pn532.remove()
+        prompt = next((t for t, c in self.keypad.log if t >= t0 and c == 'Q'), None)
+        if unlocked is None:
+            self.keypad.pins.clear()
+            return None
+        await _wait_level(self.door_pin, 0, unlocked)
+        return (prompt - t0) * 1000, (unlocked - t0) * 1000
+
+
+async def bench_taps(mode, db_path, baudrate, card, pin, taps):
+    run = Run(mode, db_path, baudrate)
+    await run.start()
+    wall = time.monotonic()
+    cpu = time.process_time()
+    prompts, unlocks = [], []
+    failed = 0
+    try:
+        for _ in range(taps):
+            result = await run.tap(card, pin)
+            if result is None:
+                failed += 1
+                continue
+            prompts.append(result[0])
+            unlocks.append(result[1])
+    finally:
+        busy = (time.process_time() - cpu) / (time.monotonic() - wall)
+        await run.stop()
+    return {'prompt': prompts, 'unlock': unlocks, 'failed': failed, 'cpu': busy}
+
+
+async def bench_idle(mode, db_path, baudrate, seconds):
+    run = Run(mode, db_path, baudrate)
+    await run.start()
+    uart = run.rf_uart
+    tx, rx = uart.tx_bytes, uart.rx_bytes
+    polls = run.pn532.commands[0x4A]
+    wall = time.monotonic()
+    cpu = time.process_time()
+    await asyncio.sleep(seconds)
+    elapsed = time.monotonic() - wall
+    busy = (time.process_time() - cpu) / elapsed
+    await run.stop()
+
+    nbytes = uart.tx_bytes - tx + uart.rx_bytes - rx
+    if mode == main.Nfc.MODE_AUTOPOLL:
+        # the reader polls by itself, count its poll periods
+        polls = elapsed / _AUTOPOLL_PERIOD
+    else:
+        polls = run.pn532.commands[0x4A] - polls
+    return {'bytes_per_poll': nbytes / polls if polls else 0, 'bytes_per_s': nbytes / elapsed, 'cpu': busy}
+
+
+async def bench_queue(mode, db_path, baudrate, users):
+    run = Run(mode, db_path, baudrate)
+    run.keypad.think_ms = PIN_THINK_MS
+    run.keypad.key_ms = PIN_KEY_MS
+    await run.start()
+    t0 = time.monotonic()
+    try:
+        for i in range(users):
+            # the next one steps up once the keypad asked the one before
+            deadline = time.monotonic() + 10
+            while (sum(1 for t, c in run.keypad.log if t >= t0 and c == main.Keypad.CMD_ENABLE_FEEDBACK) < i
+                   and time.monotonic() < deadline):
+                await asyncio.sleep(0.005)
+            await asyncio.sleep(STEP_UP)
+            run.keypad.pins.append(MIFARE_PIN)
+            taps = run.nfc.taps
+            run.pn532.place(emulator.Card.mifare(QUEUE_UID.format(i)))
+            # and takes the card away once it was read
+            deadline = time.monotonic() + 5
+            while run.nfc.taps == taps and time.monotonic() < deadline:
+                await asyncio.sleep(0.005)
+            run.pn532.remove()
+
+        deadline = time.monotonic() + users * 5
+        granted = []
+        while len(granted) < users and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            granted = [t for t, c in run.keypad.log if t >= t0 and c == main.Keypad.CMD_GRANTED]
+    finally:
+        await run.stop()
+    if not granted:
+        return {'per_minute': 0, 'granted': 0}
+    return {'per_minute': len(granted) / (granted[-1] - t0) * 60, 'granted': len(granted)}
+
+
+def _ms(values):
+    return '{:6.1f} {:6.1f} {:6.1f}'.format(percentile(values, 50), percentile(values, 90), percentile(values, 99))
+
+
+async def bench(modes, baudrate, taps, idle, users):
+    with tempfile.TemporaryDirectory() as d:
+        db_path = os.path.join(d, 'hashes.db')
+        make_db(db_path, users)
+        scenarios = [
+            ('mifare', lambda: emulator.Card.mifare(MIFARE_UID), MIFARE_PIN),
+            ('hce', lambda: emulator.Card.phone(PHONE_ID), PHONE_PIN),
+        ]
+
+        print('{:9} {:8} {:>4} {:>20} {:>20} {:>9} {:>8} {:>6}'.format(
+            'mode', 'scenario', 'taps', 'prompt ms p50/90/99', 'unlock ms p50/90/99', 'bytes/poll', 'bytes/s', 'cpu %'))
+        for mode in modes:
+            for name, card, pin in scenarios:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    r = await bench_taps(mode, db_path, baudrate, card(), pin, taps)
+                print('{:9} {:8} {:>4} {:>20} {:>20} {:>9} {:>8} {:6.1f}{}'.format(
+                    mode, name, len(r['unlock']), _ms(r['prompt']), _ms(r['unlock']), '', '', r['cpu'] * 100,
+                    '  ({} failed)'.format(r['failed']) if r['failed'] else ''))
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                r = await bench_idle(mode, db_path, baudrate, idle)
+            print('{:9} {:8} {:>4} {:>20} {:>20} {:>10.1f} {:>8.1f} {:6.1f}'.format(
+                mode, 'no-card', '', '', '', r['bytes_per_poll'], r['bytes_per_s'], r['cpu'] * 100))
+
+            if users:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    r = await bench_queue(mode, db_path, baudrate, users)
+                print('{:9} {:8} {:>4} {:>20.1f} users/min{}'.format(
+                    mode, 'queue', users, r['per_minute'],
+                    '  ({} not granted)'.format(users - r['granted']) if r['granted'] < users else ''))
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--taps', type=int, default=10, help='taps per scenario (each holds the door for 2 s)')
+    parser.add_argument('--idle', type=float, default=5, help='seconds of the no-card scenario')
+    parser.add_argument('--users', type=int, default=10, help='card holders in the queue scenario, 0 skips it')
+    parser.add_argument('--mode', choices=(main.Nfc.MODE_POLL, main.Nfc.MODE_AUTOPOLL), action='append',
+                        help='polling engine, default both')
+    parser.add_argument('--baudrate', type=int, default=main.READER_BAUDRATE, help='reader UART baud rate')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(bench(args.mode or [main.Nfc.MODE_POLL, main.Nfc.MODE_AUTOPOLL], args.baudrate, args.taps, args.idle,
+                      args.users))
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,195 @@
+"""
+Allocation microbenchmark for PN532Uart.call_function and the
+AsyncPN532Uart the lock runs.
+
+On the device (copy next to pn532.py and `import bench_pn532`) it talks to the
+real reader on UART 2 and measures heap bytes allocated per call with the GC
+disabled, which is what causes collection pauses in the poll loop. The async
+driver is measured inside a running asyncio loop.
+
+Under CPython it runs against a loopback PN532 and reports timing plus the
+tracemalloc peak per call, useful for comparing codec changes off-device.
+
+    python tools/bench_pn532.py [iterations]
+"""
+
+import sys
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+
+if not MICROPYTHON:
+    import os
+    import types
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+    _ACK = b'\x00\x00\xff\x00\xff\x00'
+
+    def _frame(data):
+        n = len(data)
+        return bytes((0, 0, 0xFF, n, (-n) & 0xFF)) + data + bytes(((-sum(data)) & 0xFF, 0))
+
+    class LoopbackUart:
+        """
+        Answers every command frame with an ACK and a firmware version. The
+        canned response is copied byte by byte so the loopback itself does
+        not show up in the allocation numbers.
+        """
+        def __init__(self, *args, **kwargs):
+            self._resp = bytearray(_ACK + _frame(bytes((0xD5, 0x03, 0x32, 0x01, 0x06, 0x07))))
+            self._pos = len(self._resp)
+
+        def any(self):
+            return len(self._resp) - self._pos
+
+        def read(self, n=None):
+            n = self.any() if n is None else min(n, self.any())
+            data = bytes(self._resp[self._pos:self._pos + n])
+            self._pos += n
+            return data
+
+        def readinto(self, buf, n=None):
+            n = min(len(buf) if n is None else n, self.any())
+            resp = self._resp
+            pos = self._pos
+            for i in range(n):
+                buf[i] = resp[pos + i]
+            self._pos = pos + n
+            return n
+
+        def write(self, data):
+            if len(data) > 6 and data[0] == 0 and data[1] == 0 and data[2] == 0xFF and data[3]:
+                # echo the command code and fix up the data checksum
+                resp = self._resp
+                resp[12] = data[6] + 1
+                s = 0
+                for i in range(11, 17):
+                    s += resp[i]
+                resp[17] = (-s) & 0xFF
+                self._pos = 0
+            return len(data)
+
+    if 'machine' not in sys.modules:
+        sys.modules['machine'] = types.SimpleNamespace(UART=LoopbackUart)
+    if 'micropython' not in sys.modules:
+        sys.modules['micropython'] = types.SimpleNamespace(const=lambda x: x)
+    if 'utime' not in sys.modules:
+        import time
+        sys.modules['utime'] = types.SimpleNamespace(
+            ticks_ms=lambda: int(time.monotonic() * 1000),
+            ticks_add=lambda a, b: a + b,
+            ticks_diff=lambda a, b: a - b)
+
+    import asyncio
+
+    class LoopbackStream:
+        """asyncio.StreamReader(uart) for LoopbackUart, which is never empty
+        when the driver waits, so this is only constructed."""
+        def __init__(self, uart):
+            self._uart = uart
+
+    if not hasattr(asyncio, 'sleep_ms'):
+        asyncio.StreamReader = LoopbackStream
+        asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+else:
+    import asyncio
+
+import gc
+from pn532 import AsyncPN532Uart, PN532Uart
+
+_COMMAND_GETFIRMWAREVERSION = 0x02
+
+
+def bench_micropython(rf, n):
+    import utime
+    rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        start = utime.ticks_us()
+        for _ in range(n):
+            rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+        elapsed = utime.ticks_diff(utime.ticks_us(), start)
+        allocated = gc.mem_alloc() - before
+    finally:
+        gc.enable()
+    print('call_function: {} us/call, {} bytes/call (~{} blocks)'.format(
+        elapsed // n, allocated // n, allocated // n // 16))
+
+
+def bench_cpython(rf, n):
+    import time
+    import tracemalloc
+
+    rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+    start = time.perf_counter()
+    for _ in range(n):
+        rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    peak = 0
+    for _ in range(n):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    print('call_function: {:.1f} us/call, tracemalloc peak {} bytes/call'.format(
+        elapsed / n * 1e6, peak))
+
+
+async def bench_async_micropython(rf, n):
+    import utime
+    await rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        start = utime.ticks_us()
+        for _ in range(n):
+            await rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+        elapsed = utime.ticks_diff(utime.ticks_us(), start)
+        allocated = gc.mem_alloc() - before
+    finally:
+        gc.enable()
+    print('async call_function: {} us/call, {} bytes/call (~{} blocks)'.format(
+        elapsed // n, allocated // n, allocated // n // 16))
+
+
+async def bench_async_cpython(rf, n):
+    import time
+    import tracemalloc
+
+    await rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+    start = time.perf_counter()
+    for _ in range(n):
+        await rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    peak = 0
+    for _ in range(n):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        await rf.call_function(_COMMAND_GETFIRMWAREVERSION)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    print('async call_function: {:.1f} us/call, tracemalloc peak {} bytes/call'.format(
+        elapsed / n * 1e6, peak))
+
+
+def main(n=1000):
+    if MICROPYTHON:
+        bench_micropython(PN532Uart(2, rx=19, tx=22), n)
+        asyncio.run(bench_async_micropython(AsyncPN532Uart(2, rx=19, tx=22), n))
+    else:
+        bench_cpython(PN532Uart(2), n)
+        asyncio.run(bench_async_cpython(AsyncPN532Uart(2), n))
+
+
+if MICROPYTHON:
+    main(100)
+elif __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
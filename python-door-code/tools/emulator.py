@@ -0,0 +1,618 @@
+"""
+CPython emulator for the lock firmware.
+
+install() puts stand-ins for the MicroPython modules the firmware imports
+(micropython, utime, machine, network, ntptime) into sys.modules and returns the
+emulated Board, after which main.py and pn532.py import unchanged:
+
+    import emulator
+    board = emulator.install()
+    import main
+
+machine.UART(n) hands out the board's UART n. UART 2 is wired to a simulated
+PN532 that parses the real HSU frames (wakeup, ACK, NACK, checksums) and answers
+GetFirmwareVersion, SAMConfiguration, RFConfiguration, InListPassiveTarget,
+InDataExchange, InRelease, PowerDown, InAutoPoll, SetSerialBaudRate and the
+Diagnose presence check. UART 1 is a scripted
+keypad and machine.Pin records every level change, so the door pin can be
+watched. Every byte takes 10 bit times at the configured baud rate and each
+command has a processing latency, so timings are in the right ballpark for
+the real hardware. The clock is time.monotonic(), nothing is sped up.
+
+asyncio.StreamReader is replaced by a stream over a UART with MicroPython's
+StreamReader(uart) interface; asyncio's own streams are not affected.
+
+    python tools/emulator.py
+
+runs a self test of the card pipeline: phones are read by their app ID,
+ISO14443-4 cards without the app (answering SELECT AID with 6A 82) by their
+own UIDs.
+"""
+
+import asyncio
+import collections
+import os
+import sys
+import time
+import types
+
+_ACK = b'\x00\x00\xff\x00\xff\x00'
+
+
+def _frame(data):
+    n = len(data)
+    return bytes((0, 0, 0xFF, n, (-n) & 0xFF)) + data + bytes(((-sum(data)) & 0xFF, 0))
+
+
+class SimUart:
+    """
+    Host side of an emulated UART. Bytes written are handed to the attached
+    device together with the time they finish arriving, bytes the device
+    sends become readable one bit time x 10 after another.
+    """
+    def __init__(self, device=None, baudrate=115200):
+        self.device = device
+        self.baudrate = baudrate
+        self.byte_time = 10 / baudrate
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self._rx = collections.deque()
+        self._last = 0.0
+        self._event = None
+
+    def init(self, baudrate=None, **kwargs):
+        if baudrate:
+            self.baudrate = baudrate
+            self.byte_time = 10 / baudrate
+
+    def deliver(self, data, at=None):
+        """Called by the device: queue `data`, the first byte arriving at `at`."""
+        t = max(time.monotonic() if at is None else at, self._last)
+        for b in data:
+            t += self.byte_time
+            self._rx.append((t, b))
+        self._last = t
+        if self._event is not None:
+            self._event.set()
+
+    def next_ready(self):
+        return self._rx[0][0] if self._rx else None
+
+    def any(self):
+        now = time.monotonic()
+        n = 0
+        for t, _ in self._rx:
+            if t > now:
+                break
+            n += 1
+        return n
+
+    def readinto(self, buf, n=None):
+        n = min(len(buf) if n is None else n, self.any())
+        rx = self._rx
+        for i in range(n):
+            buf[i] = rx.popleft()[1]
+        self.rx_bytes += n
+        return n
+
+    def read(self, n=None):
+        # like MicroPython: None when nothing arrived, b'' for read(0)
+        if n == 0:
+            return b''
+        avail = self.any()
+        n = avail if n is None else min(n, avail)
+        if not n:
+            return None
+        buf = bytearray(n)
+        self.readinto(buf)
+        return bytes(buf)
+
+    def write(self, data):
+        data = bytes(data.encode() if isinstance(data, str) else data)
+        self.tx_bytes += len(data)
+        if self.device is not None:
+            self.device.receive(self, data, time.monotonic() + len(data) * self.byte_time)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    async def wait(self):
+        """Wait until the next byte is due or the device queued something."""
+        t = self.next_ready()
+        if t is not None:
+            await asyncio.sleep(max(0.0, t - time.monotonic()))
+            return
+        if self._event is None:
+            self._event = asyncio.Event()
+        self._event.clear()
+        await self._event.wait()
+
+
+class SimStream:
+    """MicroPython's asyncio.StreamReader(uart), for SimUart."""
+    def __init__(self, uart):
+        self._uart = uart
+
+    async def readinto(self, buf):
+        while True:
+            n = self._uart.readinto(buf)
+            if n:
+                return n
+            await self._uart.wait()
+
+    async def read(self, n):
+        buf = bytearray(n)
+        n = await self.readinto(buf)
+        return bytes(buf[:n])
+
+    async def readexactly(self, n):
+        buf = bytearray(n)
+        mv = memoryview(buf)
+        got = 0
+        while got < n:
+            got += await self.readinto(mv[got:])
+        return bytes(buf)
+
+
+class Card:
+    """
+    A card or phone in the field. A phone running the HCE app answers SELECT
+    AID with `app_id` and, like Android, shows a new random UID every time
+    it is activated.
+    """
+    def __init__(self, uid=b'', sens_res=0x0044, sel_res=0x08, ats=b'', app_id=None, aid=None):
+        self.uid = uid
+        self.sens_res = sens_res
+        self.sel_res = sel_res
+        self.ats = ats
+        self.app_id = app_id
+        self.aid = aid
+        self.activations = 0
+
+    @classmethod
+    def mifare(cls, uid_hex):
+        return cls(bytes.fromhex(uid_hex))
+
+    @classmethod
+    def iso_dep(cls, uid_hex):
+        """An ISO14443-4 card without our app, e.g. DESFire."""
+        return cls(bytes.fromhex(uid_hex), 0x0344, 0x20, b'\x75\x77\x81\x02\x80')
+
+    @classmethod
+    def phone(cls, app_id_hex, aid_hex='A0000001020304'):
+        return cls(b'', 0x0004, 0x20, b'\x78\x80\x70\x02', bytes.fromhex(app_id_hex), bytes.fromhex(aid_hex))
+
+    def activate(self):
+        self.activations += 1
+        if self.app_id is not None:
+            self.uid = b'\x08' + os.urandom(3)
+        return self.uid
+
+
+class SimPN532:
+    """
+    PN532 in HSU mode. Latencies are in milliseconds: `ack_ms` until the ACK,
+    `command_ms` for simple commands, `scan_ms` for a poll that finds
+    nothing, `activate_ms` (`activate_4_ms` with RATS for ISO14443-4) for one
+    that does, and `exchange_ms` for an APDU round trip.
+
+    The chip talks at `baudrate` (115200 after a reset, SetSerialBaudRate
+    changes it). Bytes sent at another rate are lost. Above `max_baudrate`
+    the chip still hears the host but its answers arrive garbled, like a host
+    UART that cannot sample that rate.
+    """
+    FIRMWARE = b'\x32\x01\x06\x07'
+
+    BAUDRATES = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600, 1288000)
+
+    def __init__(self, ack_ms=0.5, command_ms=1, scan_ms=3, activate_ms=6, activate_4_ms=20, exchange_ms=25,
+                 max_baudrate=None):
+        self.ack_ms = ack_ms
+        self.command_ms = command_ms
+        self.scan_ms = scan_ms
+        self.activate_ms = activate_ms
+        self.activate_4_ms = activate_4_ms
+        self.exchange_ms = exchange_ms
+        self.max_baudrate = max_baudrate
+        self.baudrate = 115200
+
+        self.card = None
+        self.asleep = True
+        self.rf_on = False
+        self.target = None
+        self.commands = collections.Counter()
+        self.lost_bytes = 0
+        self.bad_frames = 0
+
+        self._buf = bytearray()
+        self._uart = None
+        self._autopoll = None
+        # the last response, sent again when the host answers it with a NACK
+        self._response = None
+        # rate SetSerialBaudRate switches to once the host acknowledged it
+        self._next_baudrate = None
+
+    # The field
+
+    def place(self, card):
+        self.card = card
+        if self._autopoll is not None:
+            # answered at the next poll period
+            start, period = self._autopoll
+            now = time.monotonic()
+            n = int((now - start) / period) + 1
+            self._autopoll = None
+            self._answer_autopoll(start + n * period)
+
+    def remove(self):
+        self.card = None
+        self.target = None
+
+    def reset(self):
+        """Power cycle the chip: asleep, field off, back at 115200."""
+        self.asleep = True
+        self.rf_on = False
+        self.target = None
+        self.baudrate = 115200
+        self._next_baudrate = None
+        self._autopoll = None
+        self._buf.clear()
+
+    # Host to PN532
+
+    def receive(self, uart, data, t):
+        self._uart = uart
+        if uart.baudrate != self.baudrate:
+            self.lost_bytes += len(data)
+            return
+        for b in data:
+            if self.asleep:
+                # only the wakeup preamble gets through to a sleeping chip
+                if b == 0x55:
+                    self.asleep = False
+                else:
+                    self.lost_bytes += 1
+                continue
+            self._buf.append(b)
+        self._parse(t)
+
+    def _parse(self, t):
+        buf = self._buf
+        while True:
+            i = buf.find(b'\x00\x00\xff')
+            if i < 0:
+                # keep a possible partial start code
+                del buf[:max(0, len(buf) - 2)]
+                return
+            del buf[:i]
+            if len(buf) < 5:
+                return
+            n = buf[3]
+            if n == 0 and buf[4] == 0xFF:
+                # ACK from the host aborts InAutoPoll, or confirms a new baud rate
+                del buf[:6]
+                self._autopoll = None
+                if self._next_baudrate:
+                    self.baudrate = self._next_baudrate
+                    self._next_baudrate = None
+                continue
+            if n == 0xFF and buf[4] == 0x00:
+                # NACK from the host: send the last response again
+                del buf[:6]
+                if self._response is not None:
+                    self._deliver(self._response, t)
+                continue
+            if (n + buf[4]) & 0xFF:
+                self.bad_frames += 1
+                del buf[:3]
+                continue
+            if len(buf) < 7 + n:
+                return
+            data = bytes(buf[5:5 + n])
+            ok = (sum(data) + buf[5 + n]) & 0xFF == 0 and n >= 2 and data[0] == 0xD4
+            del buf[:7 + n]
+            if not ok:
+                self.bad_frames += 1
+                continue
+            self._command(data[1], data[2:], t)
+
+    # PN532 to host
+
+    def _send(self, payload, at):
+        if payload is not None:
+            self._response = _frame(payload)
+            self._deliver(self._response, at)
+
+    def _deliver(self, data, at):
+        if self.max_baudrate and self.baudrate > self.max_baudrate:
+            data = bytes(b ^ 0x5A for b in data)
+        self._uart.deliver(data, at)
+
+    def _command(self, cmd, params, t):
+        self.commands[cmd] += 1
+        self._deliver(_ACK, t + self.ack_ms / 1000)
+        at = t + (self.ack_ms + self.command_ms) / 1000
+        rsp = bytes((0xD5, cmd + 1))
+
+        if cmd == 0x02:
+            self._send(rsp + self.FIRMWARE, at)
+        elif cmd == 0x14:
+            self._send(rsp, at)
+        elif cmd == 0x32:
+            if params[:1] == b'\x01':
+                self.rf_on = bool(params[1])
+                if not self.rf_on:
+                    self.target = None
+            self._send(rsp, at)
+        elif cmd == 0x4A:
+            self.rf_on = True
+            if self.card is None:
+                self._send(rsp + b'\x00', at + self.scan_ms / 1000)
+            else:
+                self._send(rsp + b'\x01' + self._activate(), at + self._activate_time())
+        elif cmd == 0x40:
+            self._send(rsp + self._exchange(params), at + self.exchange_ms / 1000)
+        elif cmd == 0x52:
+            self.target = None
+            self._send(rsp + b'\x00', at)
+        elif cmd == 0x16:
+            self._send(rsp + b'\x00', at)
+            self.asleep = True
+            self.rf_on = False
+            self.target = None
+        elif cmd == 0x00 and params[:1] == b'\x06':
+            # presence check: the selected ISO14443-4 target answers while in the field
+            card = self.target
+            ok = card is not None and card is self.card and card.sel_res & 0x20
+            self._send(rsp + (b'\x00' if ok else b'\x01'), at + self.command_ms / 1000)
+        elif cmd == 0x10:
+            if params[:1] and params[0] < len(self.BAUDRATES):
+                self._next_baudrate = self.BAUDRATES[params[0]]
+                self._send(rsp, at)
+            else:
+                self._send(b'\x7f', at)
+        elif cmd == 0x60:
+            self.rf_on = True
+            period = max(1, params[1]) * 0.15
+            if self.card is None:
+                self._autopoll = (at, period)
+            else:
+                self._answer_autopoll(at)
+        else:
+            # unsupported command: syntax error frame
+            self._send(b'\x7f', at)
+
+    def _activate_time(self):
+        ms = self.activate_4_ms if self.card.sel_res & 0x20 else self.activate_ms
+        return ms / 1000
+
+    def _activate(self):
+        # Tg, SENS_RES, SEL_RES, NFCIDLength, NFCID1, [ATS with its length byte]
+        card = self.card
+        uid = card.activate()
+        self.target = card
+        data = bytes((1, card.sens_res >> 8, card.sens_res & 0xFF, card.sel_res, len(uid))) + uid
+        if card.ats:
+            data += bytes((len(card.ats) + 1,)) + card.ats
+        return data
+
+    def _answer_autopoll(self, at):
+        target = self._activate()
+        self._send(bytes((0xD5, 0x61, 1, 0x10, len(target))) + target, at + self._activate_time())
+
+    def _exchange(self, params):
+        card = self.target
+        if card is None or params[:1] != b'\x01' or not card.sel_res & 0x20:
+            # no ISO14443-4 target: timeout status
+            return b'\x01'
+        apdu = params[1:]
+        if card.app_id is not None and apdu[:4] == b'\x00\xa4\x04\x00' and apdu[5:5 + apdu[4]] == card.aid:
+            return b'\x00' + card.app_id + b'\x90\x00'
+        # unknown AID: file not found
+        return b'\x00\x6a\x82'
+
+
+class ScriptedKeypad:
+    """
+    The keypad board: records the commands the firmware sends and types the
+    next PIN from `pins` when asked for one (CMD_ENABLE_FEEDBACK), `key_ms`
+    apart after `think_ms`.
+    """
+    def __init__(self, pins=(), think_ms=0, key_ms=0):
+        self.pins = collections.deque(pins)
+        self.think_ms = think_ms
+        self.key_ms = key_ms
+        self.log = []
+
+    def receive(self, uart, data, t):
+        for c in data.decode():
+            self.log.append((t, c))
+            if c == 'Q' and self.pins:
+                at = t + self.think_ms / 1000
+                for key in self.pins.popleft():
+                    uart.deliver(key.encode(), at)
+                    at += self.key_ms / 1000
+
+
+class Pin:
+    OUT = 1
+    IN = 0
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=IN, *args, **kwargs):
+        self.id = id
+        self.mode = mode
+        self._value = 0
+        self.history = []
+        _board.pins[id] = self
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        v = 1 if v else 0
+        if v != self._value:
+            self.history.append((time.monotonic(), v))
+        self._value = v
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+
+class WLAN:
+    def __init__(self, interface=0):
+        self._active = False
+        self._connected = False
+
+    def active(self, v=None):
+        if v is not None:
+            self._active = v
+        return self._active
+
+    def config(self, key):
+        if key == 'mac':
+            return b'\x02\x00\x00\x00\x00\x01'
+        raise ValueError(key)
+
+    def connect(self, ssid=None, key=None):
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected
+
+    def ifconfig(self):
+        return ('10.11.1.100', '255.255.255.0', '10.11.1.1', '10.11.1.1')
+
+
+class Board:
+    """The emulated ESP32: UARTs by number and the pins handed out so far."""
+    def __init__(self):
+        self.uarts = {}
+        self.pins = {}
+
+    def attach(self, uart_no, device, baudrate=115200):
+        uart = SimUart(device, baudrate)
+        self.uarts[uart_no] = uart
+        return uart
+
+    def uart(self, uart_no, baudrate=115200, **kwargs):
+        uart = self.uarts.get(uart_no)
+        if uart is None:
+            uart = self.attach(uart_no, None, baudrate)
+        else:
+            uart.init(baudrate)
+        return uart
+
+
+_board = Board()
+
+
+def _utime():
+    m = types.ModuleType('utime')
+    m.ticks_ms = lambda: int(time.monotonic() * 1000)
+    m.ticks_us = lambda: int(time.monotonic() * 1000000)
+    m.ticks_diff = lambda a, b: a - b
+    m.ticks_add = lambda a, b: a + b
+    m.sleep = time.sleep
+    m.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    m.sleep_us = lambda us: time.sleep(us / 1000000)
+    m.time = lambda: int(time.time())
+    return m
+
+
+def _machine():
+    m = types.ModuleType('machine')
+    m.UART = lambda uart_no, baudrate=115200, **kwargs: _board.uart(uart_no, baudrate)
+    m.Pin = Pin
+    m.reset = lambda: sys.exit('machine.reset()')
+    m.freq = lambda *args: 240000000
+    m.unique_id = lambda: b'\x02\x00\x00\x00\x00\x01'
+    m.idle = lambda: None
+    return m
+
+
+def _micropython():
+    # no viper: pn532 falls back to its pure Python checksum
+    m = types.ModuleType('micropython')
+    m.const = lambda x: x
+    m.mem_info = lambda *args: None
+    m.alloc_emergency_exception_buf = lambda n: None
+    return m
+
+
+def _network():
+    m = types.ModuleType('network')
+    m.STA_IF = 0
+    m.AP_IF = 1
+    m.WLAN = WLAN
+    return m
+
+
+def _ntptime():
+    # the host clock is already right
+    m = types.ModuleType('ntptime')
+    m.host = 'pool.ntp.org'
+    m.timeout = 1
+    m.settime = lambda: None
+    return m
+
+
+def install():
+    """Install the module stand-ins and return the Board."""
+    sys.modules['utime'] = _utime()
+    sys.modules['machine'] = _machine()
+    sys.modules['micropython'] = _micropython()
+    sys.modules['network'] = _network()
+    sys.modules['ntptime'] = _ntptime()
+    asyncio.StreamReader = SimStream
+    if not hasattr(asyncio, 'sleep_ms'):
+        asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    firmware = os.path.join(here, '..')
+    if firmware not in sys.path:
+        sys.path.insert(0, firmware)
+    return _board
+
+
+async def _read_tap(nfc, card):
+    _board.uarts[2].device.place(card)
+    try:
+        return await nfc.wait_uid(2000)
+    finally:
+        _board.uarts[2].device.remove()
+        await asyncio.sleep(0.5)
+
+
+async def _selftest():
+    import main
+    _board.attach(2, SimPN532())
+    nfc = main.Nfc(main.Nfc.MODE_POLL)
+    task = asyncio.create_task(nfc.loop())
+    try:
+        await asyncio.wait_for(nfc.ready.wait(), 5)
+        desfire = [await _read_tap(nfc, Card.iso_dep(uid)) for uid in ('04112233445566', '04aabbccddeeff')]
+        phone = await _read_tap(nfc, Card.phone('3F2A11BC0D99'))
+    finally:
+        task.cancel()
+    failed = 0
+    for card, uid in zip(desfire, ('04112233445566', '04aabbccddeeff')):
+        ok = card is not None and card[0] == 'mifare' and bytes(card[1]).hex() == uid
+        failed += not ok
+        print('iso-dep without app {}: {} {}'.format(uid, card, 'ok' if ok else 'FAIL'))
+    ok = phone == ('android', '3f2a11bc0d99')
+    failed += not ok
+    print('phone 3F2A11BC0D99: {} {}'.format(phone, 'ok' if ok else 'FAIL'))
+    return failed
+
+
+if __name__ == '__main__':
+    install()
+    sys.exit(1 if asyncio.run(_selftest()) else 0)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Load test of the sync server and the broker with a fleet of emulated locks.
+
+Runs N instances of main.py's Net, unchanged (_run_mqtt, _mqtt_cb, dbsync),
+in one process against a minimal MQTT broker on the same event loop and
+hashdb_server.py on a thread. asyncio.open_connection is redirected, so the
+locks still dial 10.11.1.1:1883 and :8000. The server's uplink is capped at
+--bandwidth MB/s, as on the real network, everything else runs at CPython
+speed.
+
+For every fleet size it measures
+
+    sync     a `sync` command to all locks (`sync <spread>` with --spread):
+             time until each lock reported its `sync` event, bytes and peak
+             rate the server sent, most downloads at the same time
+    events   every lock queues --events `hash` events at once: events per
+             second the broker takes in and time until all arrived
+
+    python tools/fleet_sim.py --locks 1,10,50 --digests 5000 --bandwidth 2
+    python tools/fleet_sim.py --locks 50 --spread 0,10,30
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import emulator
+
+emulator.install()
+
+import hashdb  # noqa: E402
+import main  # noqa: E402
+from events import decode_batch  # noqa: E402
+import hashdb_server  # noqa: E402
+
+MQTT_PORT = 1883
+HTTP_PORT = 8000
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def _packet(kind, body):
+    n = len(body)
+    length = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        length.append(b | 0x80 if n else b)
+        if not n:
+            return bytes((kind,)) + bytes(length) + body
+
+
+def _str(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return len(s).to_bytes(2, 'big') + s
+
+
+class Broker:
+    """
+    Just enough of an MQTT 3.1.1 broker for the locks: QoS 0, exact topics
+    and a trailing `#`, client takeover by id. Every PUBLISH is handed to
+    on_publish(topic, payload).
+    """
+    def __init__(self, on_publish=None):
+        self.on_publish = on_publish
+        self._clients = {}
+        self._subs = {}
+        self.connects = 0
+        self.takeovers = 0
+
+    async def _read(self, reader):
+        kind = (await reader.readexactly(1))[0]
+        n = shift = 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return kind, await reader.readexactly(n)
+
+    async def handle(self, reader, writer):
+        client = None
+        try:
+            while True:
+                kind, body = await self._read(reader)
+                t = kind & 0xF0
+                if t == CONNECT:
+                    n = int.from_bytes(body[10:12], 'big')
+                    client = body[12:12 + n].decode()
+                    old = self._clients.get(client)
+                    if old is not None:
+                        self.takeovers += 1
+                        old.close()
+                    self._clients[client] = writer
+                    self.connects += 1
+                    writer.write(_packet(CONNACK, b'\x00\x00'))
+                elif t == SUBSCRIBE:
+                    i = 2
+                    while i < len(body):
+                        n = int.from_bytes(body[i:i + 2], 'big')
+                        self._subs.setdefault(body[i + 2:i + 2 + n].decode(), set()).add(writer)
+                        i += 3 + n
+                    writer.write(_packet(SUBACK, body[:2] + b'\x00'))
+                elif t == PUBLISH:
+                    n = int.from_bytes(body[:2], 'big')
+                    i = 2 + n + (2 if kind & 0x06 else 0)
+                    self.publish(body[2:2 + n].decode(), body[i:])
+                elif t == PINGREQ:
+                    writer.write(_packet(PINGRESP, b''))
+                elif t == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if client is not None and self._clients.get(client) is writer:
+                del self._clients[client]
+            for subs in self._subs.values():
+                subs.discard(writer)
+            writer.close()
+
+    def publish(self, topic, payload):
+        if self.on_publish:
+            self.on_publish(topic, payload)
+        packet = _packet(PUBLISH, _str(topic) + payload)
+        for pattern, subs in self._subs.items():
+            if pattern == topic or (pattern.endswith('#') and topic.startswith(pattern[:-1])):
+                for w in subs:
+                    w.write(packet)
+
+
+class Uplink:
+    """The server's outgoing bandwidth, shared by all request threads."""
+    def __init__(self, bytes_per_s):
+        self.rate = bytes_per_s
+        self.sent = 0
+        self.active = 0
+        self.peak_active = 0
+        self.samples = []
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def take(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self.sent += n
+            self.samples.append((now, n))
+            if not self.rate:
+                return
+            self._next = max(self._next, now) + n / self.rate
+            wait = self._next - now
+        time.sleep(wait)
+
+    def enter(self, delta):
+        with self._lock:
+            self.active += delta
+            self.peak_active = max(self.peak_active, self.active)
+
+    def reset(self):
+        with self._lock:
+            self.sent = 0
+            self.peak_active = self.active
+            self.samples = []
+
+    def peak_rate(self, window=1.0):
+        samples = list(self.samples)
+        best = total = 0
+        j = 0
+        for t, n in samples:
+            total += n
+            while samples[j][0] < t - window:
+                total -= samples[j][1]
+                j += 1
+            best = max(best, total)
+        return best / window
+
+
+class _Throttled:
+    def __init__(self, f, uplink, chunk=4096):
+        self._f = f
+        self._uplink = uplink
+        self._chunk = chunk
+
+    def write(self, data):
+        for i in range(0, len(data), self._chunk):
+            part = data[i:i + self._chunk]
+            self._uplink.take(len(part))
+            self._f.write(part)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def start_server(store, uplink):
+    server = hashdb_server.serve(store, port=0, verbose=False)
+    base = server.RequestHandlerClass
+
+    class Handler(base):
+        def setup(self):
+            super().setup()
+            self.wfile = _Throttled(self.wfile, uplink)
+
+        def handle(self):
+            uplink.enter(1)
+            try:
+                super().handle()
+            except ConnectionError:
+                # the lock gave up on the download, it reports a failed sync
+                pass
+            finally:
+                uplink.enter(-1)
+
+    server.RequestHandlerClass = Handler
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def redirect(ports):
+    """Send the locks' connections to the local stand-ins, by port."""
+    open_connection = asyncio.open_connection
+
+    def shim(host, port, **kwargs):
+        return open_connection('127.0.0.1', ports[port], **kwargs)
+
+    asyncio.open_connection = shim
+
+
+class Collector:
+    """Events arriving at the broker, by name."""
+    def __init__(self):
+        self.times = {}
+        self.payloads = {}
+
+    def __call__(self, topic, payload):
+        if not topic.startswith('locks/internal/events/'):
+            return
+        now = time.monotonic()
+        name = topic[len('locks/internal/events/'):]
+        events = decode_batch(payload) if name == 'batch' else [(name, payload)]
+        for name, payload in events:
+            self.times.setdefault(name, []).append(now)
+            self.payloads.setdefault(name, []).append(payload)
+
+    def reset(self):
+        self.times = {}
+        self.payloads = {}
+
+    def count(self, name):
+        return len(self.times.get(name, ()))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+async def _until(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.02)
+    return True
+
+
+async def run_fleet(n, root, ports, uplink, spread, events, timeout):
+    """
+    One fleet on its own event loop, so the tasks Net starts (_run_mqtt,
+    _sync) end with it.
+    """
+    collector = Collector()
+    broker = Broker(collector)
+    mqtt = await asyncio.start_server(broker.handle, '127.0.0.1', 0)
+    ports[MQTT_PORT] = mqtt.sockets[0].getsockname()[1]
+
+    nets, tasks = [], []
+    for i in range(n):
+        d = os.path.join(root, 'lock{}'.format(i))
+        os.makedirs(d)
+        path = os.path.join(d, 'hashes.db')
+        hashdb.write_db(path, [], 0)
+        net = main.Net(hashdb.HashStore(path))
+        net.client_id = 'lock-{:04d}'.format(i)
+        nets.append(net)
+        tasks.append(asyncio.create_task(net.loop()))
+
+    try:
+        if not await _until(lambda: broker.connects >= n, timeout):
+            raise RuntimeError('only {} of {} locks connected'.format(broker.connects, n))
+        await asyncio.sleep(0.2)
+
+        uplink.reset()
+        t0 = time.monotonic()
+        broker.publish('locks/internal/command', 'sync {}'.format(spread).encode() if spread else b'sync')
+        await _until(lambda: collector.count('sync') >= n, timeout + spread)
+        done = [t - t0 for t in collector.times.get('sync', [])]
+        failed = sum(1 for p in collector.payloads.get('sync', []) if json.loads(p)['result'] != 'success')
+        sync = {
+            'times': done,
+            'failed': failed + n - len(done),
+            'bytes': uplink.sent,
+            'peak': uplink.peak_rate(),
+            'concurrent': uplink.peak_active,
+        }
+
+        collector.reset()
+        payload = os.urandom(32).hex().encode()
+        t0 = time.monotonic()
+        for net in nets:
+            for _ in range(events):
+                net.send_event('hash', payload)
+        await _until(lambda: collector.count('hash') >= n * events, timeout)
+        got = collector.times.get('hash', [])
+        drain = (max(got) - t0) if got else float('nan')
+        ingest = {'events': len(got), 'drain': drain, 'rate': len(got) / drain if got else 0}
+        ingest['reconnects'] = broker.connects - n
+        return sync, ingest
+    finally:
+        mqtt.close()
+
+
+def bench(sizes, spreads, digests, bandwidth, events, timeout):
+    with tempfile.TemporaryDirectory() as root:
+        store = hashdb_server.Store(os.path.join(root, 'server'))
+        rng = random.Random(0)
+        store.publish(sorted(rng.getrandbits(256).to_bytes(32, 'big') for _ in range(digests)))
+        uplink = Uplink(bandwidth * 1e6)
+        server = start_server(store, uplink)
+        ports = {HTTP_PORT: server.server_address[1]}
+        redirect(ports)
+
+        # Net.start reads the Wi-Fi credentials from the working directory
+        os.chdir(root)
+        with open('wifi', 'w') as f:
+            f.write('fleet\nsecret\n')
+
+        print('snapshot {} KB, server uplink {} MB/s'.format(len(store.snapshot(store.latest())) // 1024, bandwidth))
+        print('{:>5} {:>6} {:>22} {:>6} {:>9} {:>9} {:>5} {:>9} {:>8} {:>10}'.format(
+            'locks', 'spread', 'sync s p50/p90/max', 'failed', 'server MB', 'peak MB/s', 'conns',
+            'events/s', 'drain ms', 'reconnects'))
+        run = 0
+        for n in sizes:
+            for spread in spreads:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    sync, ingest = asyncio.run(run_fleet(
+                        n, os.path.join(root, 'run{}'.format(run)), ports, uplink, spread, events, timeout))
+                run += 1
+                t = sync['times']
+                print('{:>5} {:>6} {:>22} {:>6} {:>9.2f} {:>9.2f} {:>5} {:>9.0f} {:>8.1f} {:>10}'.format(
+                    n, spread, '{:6.2f} {:6.2f} {:6.2f}'.format(percentile(t, 50), percentile(t, 90), max(t or [0])),
+                    sync['failed'], sync['bytes'] / 1e6, sync['peak'] / 1e6, sync['concurrent'],
+                    ingest['rate'], ingest['drain'] * 1000, ingest['reconnects']))
+
+        server.shutdown()
+
+
+def _ints(text):
+    return [int(x) for x in text.split(',')]
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--locks', type=_ints, default=[1, 10, 50], help='fleet sizes, comma separated')
+    parser.add_argument('--spread', type=_ints, default=[0], help='sync spreads in seconds, comma separated')
+    parser.add_argument('--digests', type=int, default=5000, help='size of the published database')
+    parser.add_argument('--bandwidth', type=float, default=2, help='server uplink in MB/s, 0 for unlimited')
+    parser.add_argument('--events', type=int, default=20, help='events each lock queues (at most the queue size)')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for each phase')
+    args = parser.parse_args()
+    bench(args.locks, args.spread, args.digests, args.bandwidth, args.events, args.timeout)
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Compile a user roster into a hashes.db for the lock.
+
+The roster is a CSV file with the columns uid, pin and optionally type, or a
+JSON list of objects with the same keys. `uid` is the hex the reader reports
+for a card (`Card UUID (Mifare): ...` in the lock's log). For a phone it is
+the ID the Android app stores and sends: the one in its edit field after
+Modify, or `Card UUID (Android app): ...` in the lock's log. It is not the ID
+on the app's main screen, which shows the first 4 bytes reversed (e.g.
+stored 0A1B2C3D4E5F is shown as 3D2C1B0A4E5F). `type` is `mifare` (default)
+or `android`. Hashing is spread over a process pool and uses credentials.py, the
+same code the lock runs.
+
+The database is written with its version in the header, and its SHA-256 is
+written next to it as <output>.sha256.
+
+    python tools/hashdb_compile.py users.csv -o hashes.db
+    python tools/hashdb_compile.py users.json -o db/hashes.db --version 7 --verify
+    python tools/hashdb_compile.py --selftest 100000
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hashdb  # noqa: E402
+import credentials  # noqa: E402
+
+_CHUNK = 8192
+
+
+class RosterError(ValueError):
+    pass
+
+
+def read_roster(path):
+    """Return the roster as a list of (type, uid, pin) tuples."""
+    if path.endswith('.json'):
+        with open(path) as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows.get('users', [])
+    else:
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    roster = []
+    for n, row in enumerate(rows, 1):
+        try:
+            card_type = (row.get('type') or credentials.CARD_MIFARE).strip().lower()
+            uid = str(row['uid']).strip()
+            pin = str(row['pin']).strip()
+        except (KeyError, AttributeError):
+            raise RosterError('entry {}: needs uid and pin'.format(n))
+        if card_type not in (credentials.CARD_MIFARE, credentials.CARD_ANDROID):
+            raise RosterError('entry {}: unknown type {!r}'.format(n, card_type))
+        if not pin.isdigit():
+            raise RosterError('entry {}: pin must be digits'.format(n))
+        try:
+            bytes.fromhex(uid)
+        except ValueError:
+            raise RosterError('entry {}: uid must be hex'.format(n))
+        roster.append((card_type, uid, pin))
+    return roster
+
+
+def card_uid(card_type, uid):
+    """
+    What the lock hands to generate_digest() for a roster uid: the reader's
+    UID bytes for a card, or the app's ID after the trip through SELECT AID
+    (pn532.select_aid) and handle_auth for a phone.
+    """
+    raw = bytes.fromhex(uid)
+    if card_type == credentials.CARD_ANDROID:
+        return credentials.uid_bytes(card_type, credentials.hce_uid(raw))
+    return raw
+
+
+def _hash_chunk(rows):
+    generate_digest = credentials.generate_digest
+    return b''.join(generate_digest(card_uid(t, u), p) for t, u, p in rows)
+
+
+def hash_roster(roster, jobs=None):
+    """Hash the roster on `jobs` processes, returns the sorted unique digests."""
+    chunks = [roster[i:i + _CHUNK] for i in range(0, len(roster), _CHUNK)]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(chunks) < 2:
+        blobs = [_hash_chunk(c) for c in chunks]
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            blobs = pool.map(_hash_chunk, chunks)
+
+    size = hashdb.DIGEST_SIZE
+    digests = set()
+    for blob in blobs:
+        digests.update(blob[i:i + size] for i in range(0, len(blob), size))
+    return sorted(digests)
+
+
+def compile_db(roster, path, version, jobs=None):
+    """Write the database for `roster`, returns (count, sha256 hex)."""
+    digests = hash_roster(roster, jobs)
+    with hashdb.DBWriter(path, version) as w:
+        for d in digests:
+            w.add(d)
+
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    with open(path + '.sha256', 'w') as f:
+        f.write('{}  {}\n'.format(digest, os.path.basename(path)))
+    return w.count, digest
+
+
+def _reference_digest(card_type, uid, pin):
+    # the documented format, written out independently of credentials.py
+    raw = bytes.fromhex(uid)
+    if card_type == credentials.CARD_ANDROID:
+        try:
+            text = raw.decode('ascii')
+            try:
+                raw = bytes.fromhex(text)
+            except ValueError:
+                raw = text.encode()
+        except UnicodeDecodeError:
+            pass
+    s = '{:08x}:{}'.format(int(pin), raw[:4][::-1].hex())
+    return hashlib.sha256(s.encode('ascii')).digest()
+
+
+def verify(roster, path):
+    """
+    Check every roster entry against the database the way the lock does, and
+    against the documented hash format. Returns the number of failures.
+    """
+    failures = 0
+    with hashdb.HashDB(path) as db:
+        for card_type, uid, pin in roster:
+            h = credentials.generate_hash(card_uid(card_type, uid), pin)
+            ok = bytes.fromhex(h) in db and bytes.fromhex(h) == _reference_digest(card_type, uid, pin)
+            if not ok:
+                failures += 1
+                if failures <= 10:
+                    print('mismatch: {} {} {}'.format(card_type, uid, pin))
+    return failures
+
+
+def random_roster(n, seed=0):
+    rng = random.Random(seed)
+    roster = []
+    for _ in range(n):
+        if rng.random() < 0.3:
+            # the app's IDs: 12 hex characters, sent as 6 raw bytes
+            card_type = credentials.CARD_ANDROID
+            uid = ''.join(rng.choice('0123456789ABCDEF') for _ in range(12))
+        else:
+            card_type = credentials.CARD_MIFARE
+            uid = bytes(rng.getrandbits(8) for _ in range(rng.choice((4, 7)))).hex()
+        roster.append((card_type, uid, str(rng.randrange(10 ** rng.randint(4, 8)))))
+    return roster
+
+
+def selftest(n, jobs):
+    roster = random_roster(n)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'hashes.db')
+        start = time.perf_counter()
+        count, _ = compile_db(roster, path, 1, jobs)
+        elapsed = time.perf_counter() - start
+        print('compiled {} users into {} digests in {:.2f}s'.format(n, count, elapsed))
+        failures = verify(roster, path)
+    print('selftest {}: {} failures'.format('passed' if not failures else 'FAILED', failures))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('roster', nargs='?', help='users.csv or users.json')
+    parser.add_argument('-o', '--output', default='hashes.db')
+    parser.add_argument('--version', type=int, help='database version (default: one above the existing output)')
+    parser.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--verify', action='store_true', help='check every user against the written database')
+    parser.add_argument('--selftest', type=int, metavar='N', help='compile and verify N random users, then exit')
+    args = parser.parse_args()
+
+    if args.selftest:
+        sys.exit(1 if selftest(args.selftest, args.jobs) else 0)
+    if not args.roster:
+        parser.error('a roster is required')
+
+    try:
+        roster = read_roster(args.roster)
+    except (OSError, RosterError) as e:
+        sys.exit('{}: {}'.format(args.roster, e))
+
+    version = args.version
+    if version is None:
+        version = hashdb.db_version(args.output) + 1
+
+    start = time.perf_counter()
+    count, digest = compile_db(roster, args.output, version, args.jobs)
+    print('wrote {} digests for {} users to {} in {:.2f}s'.format(
+        count, len(roster), args.output, time.perf_counter() - start))
+    print('version {}'.format(version))
+    print('sha256 {}'.format(digest))
+
+    if args.verify:
+        failures = verify(roster, args.output)
+        if failures:
+            sys.exit('verify failed for {} users'.format(failures))
+        print('verified {} users'.format(len(roster)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the hash database sync server.
+
+Versions are kept as <dir>/<version>.db files in the on-device format. A lock
+asking for ?since=<version> gets a 304, a delta against that version or a
+deflate compressed snapshot, whichever is smaller. Requests without `since`
+get the legacy hex-lines file, so old firmware keeps working. Every body is
+sent with its SHA-256 in the X-Hashdb-Sha256 header.
+
+    python tools/hashdb_server.py publish --dir db hashes
+    python tools/hashdb_server.py serve --dir db --port 8000
+"""
+
+import argparse
+import functools
+import hashlib
+import os
+import struct
+import sys
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hashdb  # noqa: E402
+import dbsync  # noqa: E402
+
+
+class Store:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # published versions never change, so neither do their bodies; a
+        # fleet wide sync asks for the same few over and over
+        self.snapshot = functools.lru_cache(maxsize=4)(self.snapshot)
+        self.delta = functools.lru_cache(maxsize=16)(self.delta)
+
+    def versions(self):
+        return sorted(int(n[:-3]) for n in os.listdir(self.path) if n.endswith('.db') and n[:-3].isdigit())
+
+    def latest(self):
+        versions = self.versions()
+        return versions[-1] if versions else 0
+
+    def file(self, version):
+        return os.path.join(self.path, '{}.db'.format(version))
+
+    def digests(self, version):
+        with hashdb.HashDB(self.file(version)) as db:
+            return list(db)
+
+    def publish(self, digests):
+        version = self.latest() + 1
+        hashdb.write_db(self.file(version), digests, version)
+        return version
+
+    def snapshot(self, version):
+        with open(self.file(version), 'rb') as f:
+            return zlib.compress(f.read(), 9)
+
+    def delta(self, base, version):
+        if not os.path.exists(self.file(base)):
+            return None
+        old = set(self.digests(base))
+        new = set(self.digests(version))
+        added = sorted(new - old)
+        removed = sorted(old - new)
+        header = struct.pack('<4sB3xIIII', dbsync.DELTA_MAGIC, 1, base, version, len(added), len(removed))
+        return header + b''.join(added) + b''.join(removed)
+
+
+def make_handler(store, name):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.0'
+
+        def _send(self, status, kind=None, body=b''):
+            self.send_response(status)
+            if kind:
+                self.send_header('Content-Type', kind)
+                self.send_header(dbsync.DIGEST_HEADER, hashlib.sha256(body).hexdigest())
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/hashes/{}'.format(name):
+                return self._send(404)
+
+            latest = store.latest()
+            if latest == 0:
+                return self._send(404)
+
+            query = parse_qs(url.query)
+            if 'since' not in query:
+                body = ''.join(d.hex() + '\n' for d in store.digests(latest)).encode()
+                return self._send(200, 'text/plain', body)
+
+            since = int(query['since'][0])
+            if since == latest:
+                return self._send(304)
+
+            snapshot = store.snapshot(latest)
+            delta = store.delta(since, latest) if since else None
+            if delta is not None and len(delta) < len(snapshot):
+                return self._send(200, dbsync.CONTENT_DELTA, delta)
+            return self._send(200, dbsync.CONTENT_SNAPSHOT, snapshot)
+
+        def log_message(self, fmt, *args):
+            if self.server.verbose:
+                super().log_message(fmt, *args)
+
+    return Handler
+
+
+def serve(store, name='internal', host='127.0.0.1', port=8000, verbose=True):
+    server = ThreadingHTTPServer((host, port), make_handler(store, name))
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default='db', help='directory holding the published versions')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    p = sub.add_parser('publish', help='publish a new version from a hashes or hashes.db file')
+    p.add_argument('file')
+
+    p = sub.add_parser('serve', help='serve /hashes/<name> over http')
+    p.add_argument('--name', default='internal')
+    p.add_argument('--host', default='0.0.0.0')
+    p.add_argument('--port', type=int, default=8000)
+
+    args = parser.parse_args()
+    store = Store(args.dir)
+
+    if args.cmd == 'publish':
+        if hashdb.is_db(args.file):
+            with hashdb.HashDB(args.file) as db:
+                digests = list(db)
+        else:
+            digests = hashdb.read_hex_lines(args.file)
+        print('published version {}'.format(store.publish(digests)))
+    else:
+        server = serve(store, args.name, args.host, args.port)
+        print('serving {} on {}:{}'.format(store.path, args.host, args.port))
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()